@@ -0,0 +1,131 @@
+#!/usr/bin/python3
+
+"""
+Pool.map with chunk sizes chosen while the map runs.
+
+A fixed chunksize is either too small for tiny tasks, so every item pays a
+pickling round trip, or too large for slow ones, so one worker is left with
+the last big chunk while the others idle. adaptive_map() times each chunk
+in the worker and the round trip around it in the parent. It sizes the next
+chunk so the round-trip overhead stays a small share of the chunk's run
+time, then shrinks chunks near the end so the tail finishes together.
+
+Usage: ./adaptive_pool.py [workers]
+"""
+import json, math, os, queue, sys, time
+from multiprocessing import Pool
+
+overhead_share = 0.05	# Size chunks so the round trip costs at most this fraction of their run time
+max_chunk_seconds = 0.5	# ...but no chunk runs longer than this
+smoothing = 0.3	# Weight of the newest per-item cost in the running average
+
+def run_chunk(fn, items):
+	'Worker side: apply fn to a slice and time it'
+	start = time.perf_counter()
+	results = [fn(item) for item in items]
+	return results, time.perf_counter() - start
+
+class ChunkSizer:
+	'Running estimates of per-item cost and per-chunk overhead, turned into the next chunk size'
+
+	def __init__(self, workers):
+		self.workers = workers
+		self.cost = None	# Seconds of work per item
+		self.overhead = None	# Least round trip seen beyond the work itself; more is queueing
+		self.chunks = []	# Size of every chunk handed out, for reports
+
+	def observe(self, n, seconds, round_trip):
+		cost = seconds / n
+		self.cost = cost if self.cost is None else smoothing * cost + (1 - smoothing) * self.cost
+		overhead = max(round_trip - seconds, 0)
+		self.overhead = overhead if self.overhead is None else min(self.overhead, overhead)
+
+	def size(self, remaining):
+		'Items for the next chunk, given how many are left to hand out'
+		if self.cost is None:
+			n = 1	# Probe: nothing is known about the task yet
+		else:
+			cost = max(self.cost, 1e-9)
+			n = math.ceil(self.overhead / (overhead_share * cost))
+			n = min(n, max(int(max_chunk_seconds / cost), 1))
+		# Guided scheduling: never more than a share of what is left, so the tail is split finely
+		n = max(min(n, math.ceil(remaining / (2 * self.workers))), 1)
+		self.chunks.append(n)
+		return n
+
+def adaptive_map(pool, fn, iterable, workers=None, sizer=None):
+	'Like pool.map(fn, iterable), with adaptive chunks. workers should match the pool size'
+	items = list(iterable)
+	results = [None] * len(items)
+	sizer = sizer or ChunkSizer(workers or os.cpu_count())
+	done = queue.SimpleQueue()	# Filled by the pool's result thread
+	def submit(start, n):
+		sent = time.perf_counter()
+		pool.apply_async(run_chunk, (fn, items[start:start + n]),
+			callback=lambda result: done.put((start, sent, result)), error_callback=done.put)
+	next_item = in_flight = 0
+	while next_item < len(items) or in_flight:
+		# Two chunks per worker in flight: one running, one queued behind it
+		while next_item < len(items) and in_flight < 2 * sizer.workers:
+			n = sizer.size(len(items) - next_item)
+			submit(next_item, n)
+			next_item += n
+			in_flight += 1
+		outcome = done.get()
+		in_flight -= 1
+		if isinstance(outcome, BaseException):
+			raise outcome
+		start, sent, (chunk, seconds) = outcome
+		results[start:start + len(chunk)] = chunk
+		sizer.observe(len(chunk), seconds, time.perf_counter() - sent)
+	return results
+
+### Benchmark ###
+
+def squared(n):
+	return n * n
+
+def spin(n):
+	'CPU-bound task whose cost grows with n'
+	total = 0
+	for i in range(n):
+		total += i * i
+	return total
+
+def benchmark(workers):
+	'Items per second for fixed chunksizes and adaptive chunks on a tiny and a skewed task'
+	workloads = {
+		'squared': (squared, range(10**6)),
+		'spin': (spin, [(i * 7919) % 20000 for i in range(2000)]),	# Scattered costs
+	}
+	report = {}
+	with Pool(workers) as pool:
+		for name, (fn, items) in workloads.items():
+			items = list(items)
+			runs = report[name] = {}
+			start = time.perf_counter()
+			list(map(fn, items))
+			runs['serial'] = round(len(items) / (time.perf_counter() - start))
+			for chunksize in (1, 10, None):
+				if chunksize == 1 and len(items) > 10**5:
+					continue	# One round trip per item would take minutes
+				start = time.perf_counter()
+				pool.map(fn, items, chunksize)
+				runs['chunksize=%s' % (chunksize or 'default')] = round(len(items) / (time.perf_counter() - start))
+			sizer = ChunkSizer(workers)
+			start = time.perf_counter()
+			adaptive_map(pool, fn, items, sizer=sizer)
+			runs['adaptive'] = round(len(items) / (time.perf_counter() - start))
+			runs['adaptive_chunks'] = len(sizer.chunks)
+			runs['adaptive_largest_chunk'] = max(sizer.chunks)
+	return report
+
+if __name__ == '__main__':
+	workers = int(sys.argv[1]) if len(sys.argv) > 1 else os.cpu_count()
+	report = benchmark(workers)
+	for name, runs in report.items():
+		print(name)
+		for run, rate in runs.items():
+			if not run.startswith('adaptive_'):
+				print('  %-20s %12d items/s' % (run, rate))
+	print(json.dumps({'workers': workers, 'results': report}))
@@ -4,110 +4,936 @@
 Credit to Raymond Hettinger from his PyBay 2017 keynote talk for this example.
 Youtube: https://www.youtube.com/watch?time_continue=163&v=9zinZmE3Ogk
 """
-import asyncio, select, socket, time, types
-from collections import namedtuple
-from heapq import heappush, heappop
+import asyncio, errno, json, math, os, selectors, signal, socket, sys, time, types
+from multiprocessing import Process
+from multiprocessing.connection import wait
+
+### Timers ###
+clock = time.monotonic	# The one clock used for every scheduled event
+
+class Timer:
+	'Cancellable handle for a scheduled task'
+	__slots__ = ('when', 'tick', 'task', 'interval', 'wheel', 'slot', 'cancelled')
+
+	def __init__(self, when, task, interval=None):
+		self.when = when	# Due time on clock()
+		self.tick = 0
+		self.task = task
+		self.interval = interval	# Seconds between runs for periodic tasks
+		self.wheel = None
+		self.slot = None	# The wheel bucket currently holding this timer
+		self.cancelled = False
+
+	def cancel(self):
+		'Stop the task from running again. O(1): the timer is unlinked from its bucket'
+		self.cancelled = True
+		if self.slot is not None:
+			del self.slot[self]
+			self.slot = None
+			self.wheel.pending -= 1
+
+class TimingWheel:
+	"""Hierarchical timing wheel.
+
+	Each level is a ring of 2**bits buckets, and each bucket spans 2**bits
+	buckets of the level below. A timer lives in the level of the highest
+	tick digit in which it differs from the current tick, and it cascades
+	one level down each time the lower digits roll over. Insert, cancel
+	and expire are O(1) amortized no matter how many timers are pending.
+	Timers never fire early and fire at most one tick late.
+	"""
+
+	def __init__(self, resolution=0.01, bits=8, levels=4):
+		self.resolution = resolution	# Seconds per tick
+		self.bits = bits
+		self.mask = (1 << bits) - 1
+		self.wheels = [[{} for i in range(1 << bits)] for level in range(levels)]
+		self.overflow = {}	# Timers beyond the top level's horizon
+		self.ready = {}		# Timers that are due
+		self.tick = int(clock() / resolution)	# Last tick processed
+		self.pending = 0
+		self.scheduled = None	# Called with each timer added, by loops that sleep until timeout() rather than poll
+
+	def __len__(self):
+		return self.pending
+
+	def schedule(self, timer):
+		'Add a timer to the wheel and return it'
+		timer.tick = math.ceil(timer.when / self.resolution)
+		timer.wheel = self
+		timer.cancelled = False
+		self._place(timer)
+		self.pending += 1
+		if self.scheduled:
+			self.scheduled(timer)
+		return timer
+
+	def _place(self, timer):
+		if timer.tick <= self.tick:
+			slot = self.ready
+		else:
+			level = ((timer.tick ^ self.tick).bit_length() - 1) // self.bits
+			if level < len(self.wheels):
+				slot = self.wheels[level][(timer.tick >> (level * self.bits)) & self.mask]
+			else:
+				slot = self.overflow
+		slot[timer] = None	# Dicts give O(1) unlink on cancel and keep FIFO order
+		timer.slot = slot
+
+	def _cascade(self, slot):
+		for timer in slot:
+			self._place(timer)
+
+	def _advance(self, target):
+		'Move the wheel forward to the target tick, collecting due timers in self.ready'
+		if not self.pending:
+			self.tick = max(self.tick, target)	# Nothing to fire, jump straight there
+			return
+		bits, mask, wheels = self.bits, self.mask, self.wheels
+		while self.tick < target:
+			self.tick = t = self.tick + 1
+			# Count how many of the low tick digits just rolled over to zero
+			rolled = 0
+			while rolled < len(wheels) and not t & ((1 << (rolled + 1) * bits) - 1):
+				rolled += 1
+			if rolled == len(wheels):
+				overflow, self.overflow = self.overflow, {}
+				self._cascade(overflow)
+			# Cascade top-down so a bucket refilled from above is cascaded in turn
+			for level in range(min(rolled, len(wheels) - 1), 0, -1):
+				i = (t >> (level * bits)) & mask
+				slot, wheels[level][i] = wheels[level][i], {}
+				self._cascade(slot)
+			i = t & mask
+			slot, wheels[0][i] = wheels[0][i], {}
+			for timer in slot:
+				timer.slot = self.ready
+			self.ready.update(slot)
+
+	def expire(self, now=None):
+		'Run every task that is due. Periodic tasks are re-armed on the same handle'
+		now = clock() if now is None else now
+		self._advance(int(now / self.resolution + 1e-9))	# Absorb float error at tick edges
+		if not self.ready:
+			return
+		due, self.ready = list(self.ready), {}
+		for timer in due:
+			timer.slot = None	# So a task cancelling a later one in this batch skips it
+		self.pending -= len(due)
+		for timer in due:
+			if timer.cancelled:
+				continue
+			stats.lag.add(now - timer.when)	# How late the loop got around to it
+			stats.loop_lag = now - timer.when
+			if timer.interval is not None:
+				timer.when += timer.interval
+				if timer.when <= now:	# Fell behind, skip the missed runs
+					timer.when = now + timer.interval
+			timed(timer.task, name_of(timer.task))
+			if timer.interval is not None and not timer.cancelled:
+				self.schedule(timer)
+
+	def timeout(self):
+		'Seconds until the wheel next needs to advance, or None when nothing is pending'
+		if not self.pending:
+			return None
+		if self.ready:
+			return 0
+		# Scan ahead to the next busy bucket or the next cascade, whichever is first
+		slots, t = self.wheels[0], self.tick
+		for step in range(1, self.mask + 2 - (t & self.mask)):
+			if slots[(t + step) & self.mask]:
+				break
+		return max((t + step) * self.resolution - clock(), 0)
+
+### Instrumentation ###
+slow_callback = 0.1	# Seconds a callback may hold the loop before it is reported
+
+class Histogram:
+	'Power-of-two buckets: constant memory, percentiles good to within a factor of two'
+	__slots__ = ('scale', 'buckets', 'count', 'total', 'max')
+
+	def __init__(self, scale=1):
+		self.scale = scale	# 1e6 files seconds into microsecond buckets
+		self.buckets = [0] * 64
+		self.count = 0
+		self.total = 0
+		self.max = 0
+
+	def add(self, value):
+		self.buckets[min(int(value * self.scale).bit_length(), 63)] += 1
+		self.count += 1
+		self.total += value
+		self.max = max(self.max, value)
+
+	def percentile(self, p):
+		'Upper bound of the bucket holding the p-th fraction of samples'
+		rank = p * self.count
+		for i, n in enumerate(self.buckets):
+			rank -= n
+			if rank <= 0 and n:
+				return min((1 << i) / self.scale, self.max)
+		return self.max
+
+	def report(self, unit=1):
+		return {
+			'count': self.count,
+			'mean': round(self.total / (self.count or 1) * unit, 3),
+			'p50': round(self.percentile(0.50) * unit, 3),
+			'p99': round(self.percentile(0.99) * unit, 3),
+			'max': round(self.max * unit, 3),
+		}
+
+class Stats:
+	'Counters and histograms the loop updates as it runs; report() is served on the admin socket'
+
+	def __init__(self):
+		self.started = clock()
+		self.lag = Histogram(1e6)	# Seconds between a timer's due time and its run
+		self.ready = Histogram()	# Sockets ready per wakeup
+		self.callbacks = {}	# { callback name : Histogram of seconds it held the loop }
+		self.slow = {}	# { callback name : runs over slow_callback }
+		self.accepted = 0
+		self.accept_rate = 0	# Accepts during the last second
+		self.last_accepted = 0
+		self.peak_sessions = 0
+		self.rejected = 0	# Accepted only to be closed by the per-source rate limit
+		self.accept_pauses = 0	# Times the listener stopped accepting
+		self.loop_lag = 0	# Lag of the most recent timer, for overload detection
+
+	def sample(self):
+		'Run once a second to turn counters into rates'
+		self.accept_rate = self.accepted - self.last_accepted
+		self.last_accepted = self.accepted
+
+	def callback(self, name, elapsed):
+		histogram = self.callbacks.get(name)
+		if histogram is None:
+			histogram = self.callbacks[name] = Histogram(1e6)
+		histogram.add(elapsed)
+		if elapsed > slow_callback:
+			self.slow[name] = self.slow.get(name, 0) + 1
+			print('Slow callback %s held the loop for %.1f ms' % (name, elapsed * 1000))
+
+	def report(self):
+		return {
+			'pid': os.getpid(),
+			'uptime': round(clock() - self.started, 3),
+			'sessions': len(connections),
+			'peak_sessions': self.peak_sessions,
+			'accepted': self.accepted,
+			'accept_rate': self.accept_rate,
+			'rejected': self.rejected,
+			'accept_pauses': self.accept_pauses,
+			'timers': len(events),
+			'ready': self.ready.report(),
+			'lag_ms': self.lag.report(1000),
+			'callbacks_ms': {name: h.report(1000) for name, h in self.callbacks.items()},
+			'slow_callbacks': dict(self.slow),
+		}
+
+def name_of(fn):
+	return getattr(fn, '__qualname__', None) or repr(fn)
+
+def timed(fn, name, *args):
+	'Run a callback and record how long it held the loop'
+	start = time.perf_counter()
+	try:
+		fn(*args)
+	finally:
+		stats.callback(name, time.perf_counter() - start)
+
+stats = Stats()
 
 ### Reactor ###
-ScheduledEvent = namedtuple('ScheduleEvent', ['event_time', 'task'])
-Session = namedtuple('Session', ['address', 'file'])
+events = TimingWheel()	# Scheduled tasks bucketed by due time
+dirty = set()	# Connections written to since the last flush
+selector = None	# Created by reactor() so forked workers never share one epoll instance
+stopping = False	# Set by shutdown(): stop accepting, finish open sessions, then return
 
-events = []	#Heap with events prioritized by earliest time
-sessions = {}	# { csocket : Session(address, file) }
-callback = {}	# { csocket : callback(client, line) }
-generators = {}	# { csocket : inline callback generator }
+high_water = 64 * 1024	# Stop reading from a client once this much output is queued for it
+low_water = 16 * 1024	# Resume reading and wake drain() once it is back below this
+linger = 10	# Seconds a closed session may spend flushing its last output
+read_size = 4096	# Free space offered to each recv_into()
+max_line = 64 * 1024	# Sessions sending longer lines are ended
+IOV_MAX = os.sysconf('SC_IOV_MAX')	# Most buffers one sendmsg() call accepts
+scratch = bytearray(read_size)	# Every read lands here first; only unfinished lines are copied out
+accept_batch = 64	# Most connections taken off the accept queue per readiness event
 
-def reactor(host='localhost', port=9600):
-	'Main event loop that triggers the appropriate business logic callbacks'
+class LineBuffer:
+	'Inbound bytes for one client, read with recv_into() and split into lines in place'
+	__slots__ = ('buf', 'start', 'end', 'eof')
+
+	def __init__(self):
+		self.buf = None	# Idle clients hold no buffer at all
+		self.start = 0	# First byte not yet handed to the handler
+		self.end = 0	# One past the last byte received
+		self.eof = False
+
+	def buffered(self):
+		return self.end - self.start
+
+	def space(self):
+		'Writable view of at least read_size free bytes after the buffered data'
+		if self.start == self.end:
+			self.buf = scratch
+			self.start = self.end = 0
+		elif len(self.buf) - self.end < read_size:
+		# Slide the partial line to the front, growing only for lines longer than the buffer
+			pending = self.end - self.start
+			self.buf[:pending] = self.buf[self.start:self.end]
+			self.start, self.end = 0, pending
+			if len(self.buf) - pending < read_size:
+				self.buf.extend(bytes(pending + read_size - len(self.buf)))
+		return memoryview(self.buf)[self.end:]
+
+	def filled(self, n):
+		'Account for n bytes written into space(); 0 means EOF'
+		self.end += n
+		self.eof = not n
+
+	def fill(self, sock):
+		'Append whatever the socket has ready. Returns the byte count, 0 at EOF, None if nothing was ready'
+		try:
+			n = sock.recv_into(self.space())
+		except (BlockingIOError, InterruptedError):
+			return None
+		except ConnectionError:	# A reset ends the session just like EOF
+			n = 0
+		self.filled(n)
+		return n
+
+	def readline(self, final=False):
+		'Next complete line, or the unterminated tail when final. None if there is none'
+		if self.start == self.end:
+			return None
+		nl = self.buf.find(b'\n', self.start, self.end)
+		if nl < 0:
+			if not final:
+				return None
+			nl = self.end
+		with memoryview(self.buf) as view:
+			line = str(view[self.start:nl], 'utf-8', 'replace')	# Decodes straight from the buffer
+		self.start = min(nl + 1, self.end)
+		return line.rstrip()
+
+	def release(self):
+		'Done reading for now: keep only unconsumed bytes, and in a buffer of our own'
+		if self.start == self.end:
+			self.buf = None
+			self.start = self.end = 0
+		elif self.buf is scratch:
+			self.buf = bytearray(memoryview(scratch)[self.start:self.end])
+			self.start, self.end = 0, len(self.buf)
+
+class Connection(LineBuffer):
+	"""Everything the reactor keeps for one client in one slotted object.
+
+	It is the session key handed to handlers, and it is also its own
+	transport: output is queued and flushed with sendmsg() whenever the
+	socket is writable.
+	"""
+	__slots__ = ('sock', 'fd', 'address', 'chunks', 'size', 'reading', 'closing', 'coroutine', 'resume', 'waiting')
+
+	def __init__(self, sock, address):
+		LineBuffer.__init__(self)
+		self.sock = sock
+		self.fd = sock.fileno()
+		self.address = address
+		self.chunks = []	# Queued bytes; the head may be a memoryview of a partly sent reply
+		self.size = 0
+		self.reading = True
+		self.closing = False
+		self.coroutine = None	# The handler
+		self.resume = None	# What the handler last yielded: called with the next line
+		self.waiting = False	# The handler is suspended in drain()
+
+	@property
+	def transport(self):
+		return self
+
+	def get_write_buffer_size(self):
+		return self.size
+
+	def is_reading(self):
+		return self.reading
+
+	def write(self, data):
+		'Queue data; it goes out with everything else written during this pass of the loop'
+		if self.closing or not data:
+			return
+		self.chunks.append(data)
+		self.size += len(data)
+		dirty.add(self)
+		if self.size > high_water and self.reading:
+			self.pause_reading()	# Backpressure: a client that doesn't read doesn't get to send
+
+	def flush(self):
+		'Send as much queued output as the kernel accepts, many replies per system call'
+		chunks = self.chunks
+		while chunks and self.sock.fileno() != -1:
+			batch = chunks[:IOV_MAX]
+			try:
+				sent = self.sock.sendmsg(batch, (), socket.MSG_DONTWAIT)
+			except (BlockingIOError, InterruptedError):
+				break
+			except OSError:	# The peer went away, nobody will read the rest
+				chunks.clear()
+				self.size = 0
+				if not self.closing:
+					disconnect(self)
+				break
+			self.size -= sent
+			if sent == sum(map(len, batch)):
+				del chunks[:len(batch)]
+				continue
+			# Partial write: the socket buffer is full. Drop what went out and wait for EVENT_WRITE
+			done = 0
+			while sent >= len(chunks[done]):
+				sent -= len(chunks[done])
+				done += 1
+			del chunks[:done]
+			chunks[0] = memoryview(chunks[0])[sent:]
+			break
+		if self.sock.fileno() == -1:
+			return
+		if self.closing and not chunks:
+			self.abort()
+		elif not self.reading and not self.closing and self.size <= low_water:
+			self.resume_reading()
+			drained(self)
+		else:
+			self.register()
+
+	def register(self):
+		'Listen for the events this connection currently cares about'
+		mask = selectors.EVENT_WRITE if self.chunks else 0
+		if self.reading:
+			mask |= selectors.EVENT_READ
+		selector.modify(self.sock, mask or selectors.EVENT_READ, self)
+
+	def pause_reading(self):
+		self.reading = False
+		self.register()
+
+	def resume_reading(self):
+		self.reading = True
+		self.register()
+
+	def close(self):
+		'Flush what is queued, then close. Gives up after linger seconds'
+		self.closing = True
+		self.reading = False
+		if self.chunks:
+			self.flush()
+		if self.sock.fileno() != -1:
+			if self.chunks:
+				call_later(linger, self.abort)
+			else:
+				self.abort()
+
+	def abort(self):
+		'Close at once, discarding queued output'
+		if self.sock.fileno() != -1:
+			dirty.discard(self)
+			selector.unregister(self.sock)
+			self.sock.close()
+
+class ConnectionTable:
+	'Open connections in a list indexed by file descriptor: a lookup is one list index, no hashing'
+	__slots__ = ('slots', 'count')
+
+	def __init__(self):
+		self.slots = []
+		self.count = 0
+
+	def add(self, c):
+		if c.fd >= len(self.slots):
+			self.slots.extend([None] * max(c.fd + 1 - len(self.slots), len(self.slots)))	# Grow by doubling
+		self.slots[c.fd] = c
+		self.count += 1
+
+	def remove(self, c):
+		self.slots[c.fd] = None
+		self.count -= 1
+
+	def get(self, fd):
+		return self.slots[fd] if fd < len(self.slots) else None
+
+	def __contains__(self, c):
+		return c.fd < len(self.slots) and self.slots[c.fd] is c
+
+	def __len__(self):
+		return self.count
+
+	def __iter__(self):
+		return (c for c in self.slots if c is not None)
+
+connections = ConnectionTable()	# Every open session, indexed by file descriptor
+
+class Admission:
+	'Decides when the listener takes new sessions: session cap, per-source rate limit and overload pause'
+
+	def __init__(self, max_sessions=None, source_rate=None, source_burst=None, overload_lag=None, overload_pause=1):
+		self.max_sessions = max_sessions	# Open sessions per process before accepting stops
+		self.source_rate = source_rate	# New sessions per second allowed from one address
+		self.source_burst = source_burst or source_rate	# Sessions an idle address may open at once
+		self.overload_lag = overload_lag	# Timer lag in seconds that counts as overloaded
+		self.overload_pause = overload_pause	# Seconds to stop accepting once overloaded
+		self.buckets = {}	# { source address : (tokens, time of last refill) }
+		self.paused_until = 0
+
+	def pause(self, seconds):
+		self.paused_until = max(self.paused_until, clock() + seconds)
+
+	def accepting(self):
+		'Should the listener take another connection right now?'
+		if self.max_sessions is not None and len(connections) >= self.max_sessions:
+			return False
+		if self.overload_lag is not None and stats.loop_lag > self.overload_lag:
+			self.pause(self.overload_pause)	# Serve the sessions we have before taking on more
+		return clock() >= self.paused_until
+
+	def admit(self, address):
+		'Token bucket per source address. False means the new connection should be closed'
+		if not self.source_rate:
+			return True
+		now = clock()
+		tokens, last = self.buckets.get(address[0], (self.source_burst, now))
+		tokens = min(self.source_burst, tokens + (now - last) * self.source_rate)
+		if tokens < 1:
+			self.buckets[address[0]] = (tokens, now)
+			return False
+		self.buckets[address[0]] = (tokens - 1, now)
+		return True
+
+	def prune(self):
+		'Forget addresses whose bucket has refilled, so the table only holds recent sources'
+		now = clock()
+		for source, (tokens, last) in list(self.buckets.items()):
+			if tokens + (now - last) * self.source_rate >= self.source_burst:
+				del self.buckets[source]
+
+admission = Admission()	# No limits unless the backend is given some
+
+def flush_dirty():
+	'Flush every connection written to since the last pass: one sendmsg per client per pass'
+	while dirty:
+		dirty.pop().flush()
+
+def listener(host, port, reuse_port=False, backlog=socket.SOMAXCONN):
+	'Non-blocking listening socket. With reuse_port, sibling processes can bind the same port'
 	s = socket.socket()
+	s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+	if reuse_port:
+		s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)	# Kernel spreads new connections across the workers
 	s.bind((host,port))
-	s.listen(5)
+	s.listen(backlog)	# Connections the kernel queues for us; capped by net.core.somaxconn
 	s.setblocking(0)	#Make asynchronous. Never wait on client socket.
-	print('Server up, running, and waiting for call on %s %s' % (host, port))
+	return s
+
+def admin_listener(path):
+	'Unix socket that answers every connection with a JSON stats report'
+	if os.path.exists(path):
+		os.unlink(path)
+	a = socket.socket(socket.AF_UNIX)
+	a.bind(path)
+	a.listen(5)
+	a.setblocking(0)
+	return a
+
+def send_stats(a):
+	'Admin client: send the report through a transport so a slow reader never blocks the loop'
 	try:
-		while True:
-		# Check for a new session, add it ot the session dict, and trigger on_connect()
-			try:
-				c, a = s.accept()
-			except socket.error:
-				pass
-			else:
-				connect(c,a)
-		# Serve existing clients BUT only if they already have data ready
-		ready_to_read, _, _ = select.select(sessions, [], [], 0.1)
-		for c in ready_to_read:
-			line = sessions[c].file.readline()
-			if line:
-				callback[c](c, line.rstrip())
-			else:
-				disconnect(c)
+		conn, _ = a.accept()
+	except BlockingIOError:
+		return
+	conn.setblocking(0)
+	transport = Connection(conn, None)	# Never added to connections: output only
+	selector.register(conn, selectors.EVENT_WRITE, transport)
+	transport.write(json.dumps(stats.report()).encode() + b'\n')
+	transport.close()
+
+def accept(s):
+	'Take waiting connections off the accept queue, up to accept_batch per wakeup'
+	for i in range(accept_batch):
+		if not admission.accepting():
+			return
+		try:
+			sock, address = s.accept()
+		except (BlockingIOError, InterruptedError):
+			return	# Queue drained
+		except ConnectionAbortedError:
+			continue	# The client gave up while queued
+		except OSError as e:
+			if e.errno not in (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM):
+				raise
+		# Out of descriptors: leave the queue alone for a while rather than spin on a readable listener
+			print('Accept failed: %s, pausing' % e.strerror)
+			admission.pause(1)
+			return
+		stats.accepted += 1
+		if not admission.admit(address):
+			stats.rejected += 1
+			sock.close()
+			continue
+		connect(sock, address)
+
+def reactor(host='localhost', port=9600, reuse_port=False, drain_timeout=10, admin=None,
+		backlog=socket.SOMAXCONN, limits=None):
+	'Main event loop that triggers the appropriate business logic callbacks'
+	global selector, admission
+	selector = selectors.DefaultSelector()	# epoll on Linux, kqueue on BSD; O(ready) per wakeup
+	admission = limits or admission
+	s = listener(host, port, reuse_port, backlog)
+	selector.register(s, selectors.EVENT_READ)
+	accepting = True	# Whether s is registered for readiness
+	# Stats are served on a Unix socket: socat - UNIX-CONNECT:<admin>
+	a = admin_listener(admin) if admin else None
+	if a:
+		selector.register(a, selectors.EVENT_READ)
+	sampler = call_periodic(1, 1, stats.sample)
+	pruner = call_periodic(10, 10, admission.prune)
+	# Signals write to this socket so they interrupt the wait instead of being retried
+	wakeup, wakeup_writer = socket.socketpair()
+	wakeup.setblocking(0)
+	wakeup_writer.setblocking(0)
+	previous_wakeup_fd = signal.set_wakeup_fd(wakeup_writer.fileno())
+	selector.register(wakeup, selectors.EVENT_READ)
+	print('Server %d up, running, and waiting for call on %s %s' % (os.getpid(), host, port))
+	try:
+		while connections or not stopping:
+		# Sleep until a socket is ready or the earliest scheduled event is due
+			ready = selector.select(events.timeout())
+			stats.ready.add(len(ready))
+			for key, mask in ready:
+				c = key.fileobj
+				if c is s:
+				# New sessions are waiting: add them to the session table, and trigger on_connect()
+					accept(s)
+				elif c is wakeup:
+					wakeup.recv(4096)
+				elif c is a:
+					send_stats(a)
+				else:
+					conn = key.data
+					if mask & selectors.EVENT_WRITE:
+						conn.flush()
+					# An earlier callback may have ended or paused this session
+					if mask & selectors.EVENT_READ and conn.reading and conn in connections:
+						if conn.fill(c) is not None:
+							dispatch(conn)
 		# Run events scheduled at the appropriate event time.
-		while events and events[0].event_time <= time.monotonic():
-			event = heappop(events)
-			event.task()
-		# Don't hit 100% in a spin-wai loop
-		time.sleep(0.001)
+			events.expire(clock())
+		# Send the replies produced during this pass
+			flush_dirty()
+			if stopping and s.fileno() != -1:
+			# Drain: refuse new connections, give open sessions a grace period, then cut them off
+				if accepting:
+					selector.unregister(s)
+				s.close()
+				call_later(drain_timeout, disconnect_all)
+			elif not stopping and accepting != admission.accepting():
+			# Stop watching the listener while over a limit: new connections wait in the kernel's queue.
+			# The sampler wakes the loop every second, so a pause is always re-checked
+				accepting = not accepting
+				if accepting:
+					selector.register(s, selectors.EVENT_READ)
+				else:
+					selector.unregister(s)
+					stats.accept_pauses += 1
 	finally:
-		s.close()
+		sampler.cancel()
+		pruner.cancel()
+		signal.set_wakeup_fd(previous_wakeup_fd)
+		selector.close()
+		for sock in (s, wakeup, wakeup_writer):
+			sock.close()
+		if a:
+			a.close()
+			os.unlink(admin)
+
+def shutdown(*args):
+	'Ask the reactor to drain and return. Safe to use as a signal handler'
+	global stopping
+	stopping = True
+	if stopped:
+		stopped.set()
+
+def disconnect_all():
+	'End every open session'
+	for c in list(connections):
+		disconnect(c)
 
-def connect(c, a):
+def dispatch(c):
+	'Feed every complete buffered line to the handler until it pauses or the session ends'
+	while c in connections and c.transport.is_reading():
+		line = c.readline(final=c.eof)
+		if line is not None:
+			timed(c.resume, name_of(c.coroutine), c, line)
+		elif c.eof:
+			disconnect(c)
+		elif c.buffered() > max_line:
+			write(c, b'<line too long>\r\n')
+			disconnect(c)
+		else:
+			break
+	c.release()
+
+def drained(c):
+	'Output drained below low_water: wake a handler waiting in drain() and serve lines that piled up'
+	if c.waiting:
+		c.waiting = False
+		advance(c, None)
+	if c in connections:
+		dispatch(c)
+
+def connect(sock, address):
 	'Reactor logic for new connections'
-	sessions[c] = Session(a, c.makefile())
+	sock.setblocking(0)
+	c = Connection(sock, address)
+	connections.add(c)
+	stats.peak_sessions = max(stats.peak_sessions, len(connections))
+	selector.register(sock, selectors.EVENT_READ, c)
 	on_connect(c) # Call into user's business logic
 
 def disconnect(c):
 	'Reactor logic to end sessions'
+	if c not in connections:
+		return
 	on_disconnect(c) # Call into user's business logic
-	sessions[c].file.close()
-	c.close()
-	del sessions[c]
-	del callback[c]
+	connections.remove(c)
+	c.coroutine = c.resume = None	# Break the handler <-> connection reference cycle
+	c.waiting = False
+	c.transport.close()
 
 def add_task(event_time, task):
-	'Helper function to schedule one-time tasks at specific time'
-	heappush(events, ScheduledEvent(event_time, task))
+	'Helper function to schedule one-time tasks at specific clock() time. Returns a cancellable Timer'
+	return events.schedule(Timer(event_time, task))
 
 def call_later(delay, task):
 	'Helper function to schedule one-time tasks after a given delay'
-	add_task(time.time() + delay, task)
+	return add_task(clock() + delay, task)
 
 def call_periodic(delay, interval, task):
-	'Helper function to schedule recurring tasks'
-	def inner():
-		task()
-		call_later(interval, inner)
-	call_later(delay, inner)
+	'Helper function to schedule recurring tasks. Cancelling the returned Timer stops them'
+	return events.schedule(Timer(clock() + delay, task, interval))
+
+### Pre-fork supervisor ###
+
+def worker(host, port, drain_timeout, backend='reactor', admin=None, options={}):
+	'Worker process: one reactor per core, all sharing the SO_REUSEPORT port'
+	signal.signal(signal.SIGTERM, shutdown)	# The supervisor asks us to drain with SIGTERM
+	signal.signal(signal.SIGINT, signal.SIG_IGN)	# Ctrl-C is handled by the supervisor alone
+	admin = admin and '%s.%d' % (admin, os.getpid())	# One stats socket per worker
+	backends[backend](host, port, reuse_port=True, drain_timeout=drain_timeout, admin=admin, **options)
+
+def supervisor(host='localhost', port=9600, workers=None, drain_timeout=10, backend='reactor', admin=None, **options):
+	'Fork one reactor worker per core, restart any that crash and drain them all on shutdown'
+	# options (backlog, limits) go to each worker's backend; limits apply per worker
+	workers = workers or os.cpu_count()
+	procs = {}	# { sentinel : (Process, start time) }
+	def spawn():
+		p = Process(target=worker, args=(host, port, drain_timeout, backend, admin, options))
+		p.start()
+		procs[p.sentinel] = (p, clock())
+	signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+	print('Supervisor %d starting %d workers on %s %s' % (os.getpid(), workers, host, port))
+	try:
+		for i in range(workers):
+			spawn()
+		while True:
+			for sentinel in wait(list(procs)):
+				p, started = procs.pop(sentinel)
+				p.join()
+				print('Worker %d exited with code %s, restarting' % (p.pid, p.exitcode))
+				if clock() - started < 1:
+					time.sleep(1)	# Don't fork-bomb when a worker dies at startup
+				spawn()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		for p, started in procs.values():
+			p.terminate()	# SIGTERM: the worker stops accepting and drains its sessions
+		for p, started in procs.values():
+			p.join(drain_timeout + 1)
+			if p.is_alive():
+				p.kill()
+		print('Supervisor %d stopped' % os.getpid())
+
+### asyncio backend ###
+
+class LineProtocol(LineBuffer, asyncio.BufferedProtocol):
+	'Runs the same handlers on a stdlib asyncio loop, holding the same per-connection state as Connection'
+	__slots__ = ('fd', 'address', 'transport', 'coroutine', 'resume', 'waiting')
+
+	def __init__(self):
+		LineBuffer.__init__(self)
+		self.coroutine = self.resume = None
+		self.waiting = False
+
+	def connection_made(self, transport):
+		transport.set_write_buffer_limits(high_water, low_water)
+		self.transport = transport
+		self.fd = transport.get_extra_info('socket').fileno()
+		self.address = transport.get_extra_info('peername')
+		stats.accepted += 1
+		# asyncio accepts on its own, so over a limit the best we can do is hang up straight away
+		if not admission.accepting() or not admission.admit(self.address):
+			stats.rejected += 1
+			transport.abort()
+			return
+		connections.add(self)
+		stats.peak_sessions = max(stats.peak_sessions, len(connections))
+		on_connect(self)
+
+	def get_buffer(self, sizehint):
+		return self.space()	# asyncio calls recv_into() on this for us
+
+	def buffer_updated(self, nbytes):
+		self.filled(nbytes)
+		dispatch(self)
+
+	def eof_received(self):
+		if self in connections:
+			self.eof = True
+			dispatch(self)
+		return True	# disconnect() closes the transport once the handler is done
+
+	def pause_writing(self):
+		self.transport.pause_reading()	# Same backpressure as Connection
+
+	def resume_writing(self):
+		if self in connections:
+			self.transport.resume_reading()
+			drained(self)
+
+	def connection_lost(self, exc):
+		disconnect(self)
+		if all_closed and not connections:
+			all_closed.set()
+
+async def answer_stats(reader, writer):
+	writer.write(json.dumps(stats.report()).encode() + b'\n')
+	writer.close()
+
+class WheelTimer:
+	'Drives the timing wheel from an asyncio loop with one loop timer for its next expiry, re-armed as timers change'
+
+	def __init__(self, loop):
+		self.loop = loop
+		self.handle = self.due = None
+		events.scheduled = self.scheduled
+		self.arm()
+
+	def arm(self):
+		if self.handle:
+			self.handle.cancel()
+		timeout = events.timeout()
+		self.handle = self.due = None
+		if timeout is not None:
+			self.due = clock() + timeout
+			self.handle = self.loop.call_later(timeout, self.fire)
+
+	def fire(self):
+		events.expire(clock())
+		self.arm()
+
+	def scheduled(self, timer):
+		if self.due is None or timer.tick * events.resolution < self.due:
+			self.arm()	# Due before the loop timer: wake up earlier
+
+	def close(self):
+		events.scheduled = None
+		if self.handle:
+			self.handle.cancel()
+
+stopped = None	# asyncio.Event set by shutdown(), which the asyncio backend waits on
+all_closed = None	# asyncio.Event set when the last session ends, while the asyncio backend drains
+
+async def serve_asyncio(host, port, reuse_port, drain_timeout, admin, backlog):
+	'Accept on an asyncio server and drive the timing wheel until shutdown() and the drain are done'
+	global stopped, all_closed
+	loop = asyncio.get_running_loop()
+	server = await loop.create_server(LineProtocol, host, port, reuse_address=True, reuse_port=reuse_port or None,
+		backlog=backlog)
+	if admin:
+		await asyncio.start_unix_server(answer_stats, sock=admin_listener(admin))
+	wheel = WheelTimer(loop)
+	sampler = call_periodic(1, 1, stats.sample)
+	pruner = call_periodic(10, 10, admission.prune)
+	stopped = asyncio.Event()
+	if stopping:
+		stopped.set()
+	if signal.getsignal(signal.SIGTERM) is shutdown:
+		loop.add_signal_handler(signal.SIGTERM, shutdown)	# Through the loop, so the signal wakes it
+	print('Server %d (asyncio) up, running, and waiting for call on %s %s' % (os.getpid(), host, port))
+	await stopped.wait()
+	server.close()
+	if connections:
+		all_closed = asyncio.Event()
+		cutoff = call_later(drain_timeout, disconnect_all)
+		await all_closed.wait()
+		cutoff.cancel()
+	disconnect_all()
+	sampler.cancel()
+	pruner.cancel()
+	wheel.close()
+	await asyncio.sleep(events.resolution)	# Let the transports flush their goodbyes
+	if admin:
+		os.unlink(admin)
+
+def asyncio_reactor(host='localhost', port=9600, reuse_port=False, drain_timeout=10, admin=None,
+		backlog=socket.SOMAXCONN, limits=None):
+	'Drop-in alternative to reactor() built on asyncio'
+	global admission
+	admission = limits or admission
+	asyncio.run(serve_asyncio(host, port, reuse_port, drain_timeout, admin, backlog))
+
+backends = {'reactor': reactor, 'asyncio': asyncio_reactor}
 
 def on_connect(c):
 	g = nbcaser(c) 	  	   # 'g' is a coroutine
-	generators[c] = g 	   # generators -> awaitables
-	callback[c] = g.send(None) # We do this to advance nbcaser coroutine
+	c.coroutine = g 	   # generators -> awaitables
+	c.resume = g.send(None)	   # We do this to advance nbcaser coroutine
 				   # to yield through the 'readline' coroutine
 				   # which will sleep on its 'yield' expression
 
 def on_disconnect(c):
-	g = generators.pop(c)
-	g.close()
+	c.coroutine.close()
+
+def advance(c, value):
+	'Resume the handler with value. It runs until it yields the callback for its next wait'
+	try:
+		c.resume = c.coroutine.send(value) # send() resumes the handler at its yield point
+	except StopIteration:
+		disconnect(c)
 
 @types.coroutine
 def readline(c):
 	'A non-blocking readline to use with two-way generators'
-	def inner(c, line):
-		g = generators[c]
-		try:
-			callback[c] = g.send(line) # g.send(line) will resume the ield inner point
-		except StopIteration:
-			disconnect(c)
-	line = yield inner
+	line = yield advance	# dispatch() calls advance(c, line) when the next line arrives
 	return line
 	
 	def sleep(c, delay):
 		'A non-blocking sleep to use with two-way generators'
 		def inner():
-			g = generators[c]
-			callback[c] = next(g)
+			g = c.coroutine
+			c.resume = next(g)
 			call_later(delay, inner)
-			return lambda *args: callback[c]
+			return lambda *args: c.resume
+
+def write(c, data):
+	'Queue bytes for the client. Replies are buffered and sent when the socket is writable'
+	c.transport.write(data)
+
+@types.coroutine
+def drain(c):
+	'Wait, without blocking the loop, until the client has read enough of its queued output'
+	if c.transport.is_reading():
+		return
+	c.waiting = True
+	yield advance	# drained() calls advance(c, None)
 
 ### User's Business Logic
 
@@ -116,33 +942,40 @@ def announcement():
 
 call_periodic(delay=1, interval=15, task=announcement)
 
-@asyncio.coroutine
+@types.coroutine
 def nbcaser(c):
 	upper, title = 'upper', 'title'
 	mode = upper
-	print('Received connection from', sessions[c].address)
+	print('Received connection from', c.address)
 	try:
-		c.sendall(b'<welcome: starting in upper case mode>\r\n')
+		write(c, b'<welcome: starting in upper case mode>\r\n')
 		while 1:
 			line = yield from readline(c)
 			if line == 'quit':
-				c.sendall(b'quit\r\n')
+				write(c, b'quit\r\n')
 				return
 			if mode is upper and line == 'title':
-				c.sendall(b'<switching to title case mode>\r\n')
+				write(c, b'<switching to title case mode>\r\n')
 				mode = title
 				continue
 			if mode is title and line == 'upper':
-				c.sendall(b'<switching to upper case mode>\r\n')
+				write(c, b'<switching to upper case mode>\r\n')
 				mode = upper
 				continue
-			print(sessions[c].address, '-->', line)
+			print(c.address, '-->', line)
 			if mode is upper:
-				c.sendall('%a\r\n' % line.upper())
+				write(c, b'%a\r\n' % line.upper())
 			else:
-				c.sendall('%a\r\n' % line.title())
+				write(c, b'%a\r\n' % line.title())
+			yield from drain(c)
 	finally:
-		print(sessions[c].address, 'quit')
+		print(c.address, 'quit')
 
 if __name__ == '__main__':
-	reactor('localhost', 9600)
+	# ./async_example.py [workers [reactor|asyncio [admin socket path]]]
+	backend = sys.argv[2] if len(sys.argv) > 2 else 'reactor'
+	admin = sys.argv[3] if len(sys.argv) > 3 else None
+	if len(sys.argv) > 1 and int(sys.argv[1]) > 1:
+		supervisor('localhost', 9600, workers=int(sys.argv[1]), backend=backend, admin=admin)
+	else:
+		backends[backend]('localhost', 9600, admin=admin)
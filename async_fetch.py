@@ -0,0 +1,347 @@
+#!/usr/bin/python3
+
+"""
+asyncio HTTP/1.1 fetcher with keep-alive connection pools, for the
+sitesize() example in pyconcurrency.py.
+
+sitesize() on a ThreadPool(10) opens a new connection for every URL, so
+each fetch pays for DNS, the TCP handshake and TLS. No more than ten are
+ever in flight. A Fetcher keeps a pool of idle keep-alive connections per
+(scheme, host, port) and reuses them. A global and a per-host limit bound
+the requests in flight, and every request has a deadline. imap_unordered()
+is the drop-in for pool.imap_unordered(sitesize, sites): it yields results
+as fetches complete, from ordinary synchronous code.
+
+StandInServer is a local HTTP/1.1 server with configurable latency,
+connection set-up cost and per-connection bandwidth, with byte-range
+support, for tests and the benchmarks.
+
+Usage: ./async_fetch.py [--urls 1000 10000 100000] [--hosts 4] [--latency 0.005] [--handshake 0.01]
+"""
+import argparse, asyncio, json, ssl, time, urllib.request
+from collections import Counter, defaultdict, deque, namedtuple
+from multiprocessing import Pipe, Process
+from multiprocessing.pool import ThreadPool
+from urllib.parse import urlsplit
+
+Response = namedtuple('Response', ['url', 'status', 'headers', 'body'])	# headers: { lowercase name : value }
+
+default_ports = {'http': 80, 'https': 443}
+read_ahead = 10000	# URLs imap_unordered holds back while their host is full, so a run of one host can't stall the rest
+
+def host_key(parts):
+	return parts.scheme, parts.hostname, parts.port or default_ports[parts.scheme]
+
+class HostPool:
+	'Idle keep-alive connections to one (scheme, host, port), and the per-host request limit'
+
+	def __init__(self, scheme, host, port, limit):
+		self.scheme, self.host, self.port = scheme, host, port
+		self.slots = asyncio.Semaphore(limit)
+		self.idle = deque()	# (reader, writer, idle since), most recently used last
+
+	async def connect(self, idle_timeout):
+		'(reader, writer, reused): the freshest idle connection, or a new one'
+		while self.idle:
+			reader, writer, since = self.idle.pop()
+			if time.monotonic() - since < idle_timeout and not reader.at_eof():
+				return reader, writer, True
+			writer.close()
+		context = ssl.create_default_context() if self.scheme == 'https' else None
+		reader, writer = await asyncio.open_connection(self.host, self.port, ssl=context)
+		return reader, writer, False
+
+	def release(self, reader, writer, keep):
+		if keep:
+			self.idle.append((reader, writer, time.monotonic()))
+		else:
+			writer.close()
+
+	def close(self):
+		while self.idle:
+			self.idle.pop()[1].close()
+
+async def read_response(reader, method):
+	'(status, headers, body, keep_alive) of one response'
+	status_line = await reader.readline()
+	if not status_line:
+		raise ConnectionResetError('connection closed before the response')
+	version, status = status_line.decode('latin-1').split(None, 2)[:2]
+	status = int(status)
+	headers = {}
+	while True:
+		line = await reader.readline()
+		if line in (b'\r\n', b'\n', b''):
+			break
+		name, _, value = line.decode('latin-1').partition(':')
+		name, value = name.strip().lower(), value.strip()
+		headers[name] = headers[name] + ', ' + value if name in headers else value
+	keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+	if method == 'HEAD' or status in (204, 304) or 100 <= status < 200:
+		body = b''
+	elif 'chunked' in headers.get('transfer-encoding', '').lower():
+		chunks = []
+		while True:
+			size = int((await reader.readline()).split(b';')[0], 16)
+			if not size:
+				break
+			chunks.append(await reader.readexactly(size))
+			await reader.readline()
+		while (await reader.readline()) not in (b'\r\n', b'\n', b''):	# Trailers
+			pass
+		body = b''.join(chunks)
+	elif 'content-length' in headers:
+		body = await reader.readexactly(int(headers['content-length']))
+	else:
+		body, keep_alive = await reader.read(), False	# Delimited by the server closing
+	return status, headers, body, keep_alive
+
+class Fetcher:
+	'HTTP/1.1 client with per-host keep-alive pools. Use from one event loop; close() when done'
+
+	def __init__(self, limit=100, per_host=10, timeout=30, connect_timeout=10, idle_timeout=30, headers=None):
+		self.slots = asyncio.Semaphore(limit)	# Requests in flight across all hosts
+		self.limit, self.per_host, self.timeout = limit, per_host, timeout
+		self.connect_timeout, self.idle_timeout = connect_timeout, idle_timeout
+		self.headers = dict(headers or {})
+		self.pools = {}	# { (scheme, host, port) : HostPool }
+		self.connections = self.requests = 0
+
+	def pool(self, parts):
+		key = host_key(parts)
+		if key not in self.pools:
+			self.pools[key] = HostPool(*key, self.per_host)
+		return self.pools[key]
+
+	async def fetch(self, url, method='GET', headers=None):
+		'One request, within the global and per-host limits. asyncio.TimeoutError after timeout seconds'
+		parts = urlsplit(url)
+		pool = self.pool(parts)
+		async with pool.slots, self.slots:	# Host first: waiting on a busy host mustn't hold a global slot
+			return await asyncio.wait_for(self.request(pool, parts, url, method, headers or {}), self.timeout)
+
+	async def request(self, pool, parts, url, method, headers):
+		target = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+		lines = ['%s %s HTTP/1.1' % (method, target), 'Host: %s' % parts.netloc]
+		lines += ['%s: %s' % item for item in {**self.headers, **headers}.items()]
+		request = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+		while True:
+			reader, writer, reused = await asyncio.wait_for(pool.connect(self.idle_timeout), self.connect_timeout)
+			self.connections += not reused
+			try:
+				writer.write(request)
+				status, response_headers, body, keep_alive = await read_response(reader, method)
+			except (ConnectionError, asyncio.IncompleteReadError):
+				writer.close()
+				if reused:
+					continue	# The server dropped an idle connection: retry once on a new one
+				raise
+			except BaseException:	# Timed out or cancelled mid-response: the connection is unusable
+				writer.close()
+				raise
+			self.requests += 1
+			pool.release(reader, writer, keep_alive)
+			return Response(url, status, response_headers, body)
+
+	async def imap_unordered(self, fn, urls, return_exceptions=False):
+		'''Async generator of fn(response) for each URL as fetches complete. At most twice the limit are queued,
+		and no more than twice the per-host limit for any one host: URLs for a full host wait in read-ahead'''
+		async def one(url):
+			try:
+				return fn(await self.fetch(url))
+			except Exception as e:
+				if return_exceptions:
+					return e
+				raise
+		urls = iter(urls)
+		pending, done = {}, set()	# pending: { task : host key }
+		busy = Counter()	# Pending tasks per host
+		held = defaultdict(deque)	# { host key : URLs read ahead while it was full }
+		window, host_window = 2 * self.limit, 2 * self.per_host
+		held_count = 0
+		def start(url, key):
+			pending[asyncio.ensure_future(one(url))] = key
+			busy[key] += 1
+		try:
+			while True:
+				for key in [key for key in held if busy[key] < host_window]:
+					while held[key] and busy[key] < host_window and len(pending) < window:
+						start(held[key].popleft(), key)
+						held_count -= 1
+					if not held[key]:
+						del held[key]
+				while len(pending) < window and held_count < read_ahead:
+					url = next(urls, None)
+					if url is None:
+						break
+					key = host_key(urlsplit(url))
+					if busy[key] < host_window and key not in held:
+						start(url, key)
+					else:
+						held[key].append(url)
+						held_count += 1
+				if not pending:
+					return
+				done = (await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED))[0]
+				for task in done:
+					busy[pending.pop(task)] -= 1
+				for task in done:
+					yield task.result()
+		finally:
+			for task in pending:
+				task.cancel()
+			for task in done:	# Finished alongside one that raised: don't warn that their errors went unread
+				if not task.cancelled():
+					task.exception()
+
+	def close(self):
+		for pool in self.pools.values():
+			pool.close()
+
+def size(response):
+	'sitesize() for a Response'
+	return response.url, len(response.body)
+
+def imap_unordered(fn, urls, return_exceptions=False, **options):
+	'Like ThreadPool.imap_unordered(), but fn gets each URL\'s Response. options go to Fetcher'
+	loop = asyncio.new_event_loop()
+	fetcher = loop.run_until_complete(make_fetcher(options))
+	results = fetcher.imap_unordered(fn, urls, return_exceptions)
+	try:
+		while True:
+			try:
+				yield loop.run_until_complete(results.__anext__())
+			except StopAsyncIteration:
+				return
+	finally:
+		loop.run_until_complete(results.aclose())
+		fetcher.close()
+		loop.run_until_complete(asyncio.sleep(0))	# Let the transports finish closing
+		loop.close()
+
+async def make_fetcher(options):
+	return Fetcher(**options)	# Created inside the loop its semaphores will belong to
+
+### Local stand-in server ###
+
+def stand_in_body(size):
+	'What StandInServer serves: byte i is i % 256, so misplaced ranges show up'
+	return (bytes(range(256)) * (size // 256 + 1))[:size]
+
+def byte_range(header, size):
+	'(start, stop) for a single "bytes=" Range header, None to ignore it, or () if it can\'t be satisfied'
+	unit, _, spec = header.partition('=')
+	if unit.strip() != 'bytes' or ',' in spec:
+		return None	# Multiple ranges: serve the whole body instead
+	first, _, last = spec.strip().partition('-')
+	if not first:
+		start, stop = max(size - int(last), 0), size	# Suffix: the last n bytes
+	else:
+		start, stop = int(first), min(int(last) + 1, size) if last else size
+	return (start, stop) if start < stop else ()
+
+async def handle(reader, writer, body, latency, handshake, rate, ranges):
+	'''One keep-alive connection: answer every request with body, after latency (plus handshake on the first).
+	Honours single byte ranges if ranges is set, and sends at most rate bytes/s if it is given'''
+	delay = latency + handshake
+	try:
+		while True:
+			request = (await reader.readuntil(b'\r\n\r\n')).decode('latin-1').split('\r\n')
+			method, path, version = request[0].split(' ')
+			headers = {name.strip().lower(): value.strip() for name, _, value in (line.partition(':') for line in request[1:] if line)}
+			close = version == 'HTTP/1.0' or headers.get('connection', '').lower() == 'close'
+			if delay:
+				await asyncio.sleep(delay)
+			delay = latency
+			span = byte_range(headers['range'], len(body)) if ranges and 'range' in headers else None
+			extra = b'Accept-Ranges: bytes\r\n' if ranges else b''
+			if path.startswith('/status/'):	# Error pages on demand, for tests
+				status, content, extra = path[len('/status/'):].encode() + b' Stand-in', b'stand-in error page', b''
+			elif span == ():
+				status, content, extra = b'416 Range Not Satisfiable', b'', extra + b'Content-Range: bytes */%d\r\n' % len(body)
+			elif span:
+				status, content = b'206 Partial Content', memoryview(body)[span[0]:span[1]]
+				extra += b'Content-Range: bytes %d-%d/%d\r\n' % (span[0], span[1] - 1, len(body))
+			else:
+				status, content = b'200 OK', memoryview(body)
+			writer.write(b'HTTP/1.1 %s\r\nContent-Type: application/octet-stream\r\nContent-Length: %d\r\n%s%s\r\n'
+				% (status, len(content), extra, b'Connection: close\r\n' if close else b''))
+			if method != 'HEAD':
+				piece = max(int(rate * 0.01), 1) if rate else len(content) or 1	# Paced in 10 ms slices
+				for i in range(0, len(content), piece):
+					writer.write(content[i:i + piece])
+					await writer.drain()
+					if rate:
+						await asyncio.sleep(len(content[i:i + piece]) / rate)
+			await writer.drain()
+			if close:
+				break
+	except (asyncio.IncompleteReadError, ConnectionError):
+		pass
+	finally:
+		writer.close()
+
+def serve(conn, hosts, body_size, latency, handshake, rate, ranges):
+	async def main():
+		body = stand_in_body(body_size)
+		servers = [await asyncio.start_server(lambda r, w: handle(r, w, body, latency, handshake, rate, ranges), '127.0.0.1', 0, backlog=1024)
+			for i in range(hosts)]
+		conn.send([server.sockets[0].getsockname()[1] for server in servers])
+		await asyncio.Event().wait()
+	asyncio.run(main())
+
+class StandInServer:
+	'''HTTP/1.1 server in a child process, listening on one port per simulated host. bases holds their root URLs.
+	rate caps each connection\'s bytes/s, like a high-latency link; ranges=False makes it ignore Range headers.
+	/status/<code> answers with that status and a short error page'''
+
+	def __init__(self, hosts=1, body_size=16384, latency=0.0, handshake=0.0, rate=None, ranges=True):
+		parent, child = Pipe()
+		self.process = Process(target=serve, args=(child, hosts, body_size, latency, handshake, rate, ranges), daemon=True)
+		self.process.start()
+		self.bases = ['http://127.0.0.1:%d' % port for port in parent.recv()]
+
+	def close(self):
+		self.process.terminate()
+		self.process.join()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+### Benchmark ###
+
+def sitesize(url):
+	'The ThreadPool version from pyconcurrency.py'
+	with urllib.request.urlopen(url) as u:
+		page = u.read()
+		return url, len(page)
+
+def benchmark(counts, hosts, latency, handshake, limit, per_host):
+	report = []
+	with StandInServer(hosts, latency=latency, handshake=handshake) as server:
+		for n in counts:
+			urls = ['%s/page/%d' % (server.bases[i % hosts], i) for i in range(n)]
+			start = time.perf_counter()
+			with ThreadPool(10) as pool:
+				assert sum(1 for result in pool.imap_unordered(sitesize, urls)) == n
+			threads = time.perf_counter() - start
+			start = time.perf_counter()
+			assert sum(1 for result in imap_unordered(size, urls, limit=limit, per_host=per_host)) == n
+			fetcher = time.perf_counter() - start
+			report.append({'urls': n, 'threadpool_seconds': round(threads, 3), 'async_seconds': round(fetcher, 3),
+				'threadpool_urls_per_sec': round(n / threads), 'async_urls_per_sec': round(n / fetcher)})
+	return report
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+	parser.add_argument('--urls', type=int, nargs='+', default=[1000, 10000])
+	parser.add_argument('--hosts', type=int, default=4)
+	parser.add_argument('--latency', type=float, default=0.005, help='server think time per request, in seconds')
+	parser.add_argument('--handshake', type=float, default=0.01, help='extra delay on a connection\'s first request, for DNS, TCP and TLS set-up')
+	parser.add_argument('--limit', type=int, default=100)
+	parser.add_argument('--per-host', type=int, default=25)
+	args = parser.parse_args()
+	print(json.dumps(benchmark(args.urls, args.hosts, args.latency, args.handshake, args.limit, args.per_host), indent=2))
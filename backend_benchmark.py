@@ -0,0 +1,78 @@
+#!/usr/bin/python3
+
+"""
+Run the nbcaser handler from async_example.py on each backend and compare
+lines per second and round-trip latency under the same pipelined load.
+Then check each one's backpressure: a client that stops reading must pause
+its session, and get every reply once it reads again.
+
+Usage: ./backend_benchmark.py [connections] [seconds] [pipeline depth]
+"""
+import json, os, socket, sys, threading, time
+from multiprocessing import Process
+
+import async_example, loadgen
+
+def serve(backend, port):
+	'Server process. nbcaser prints every line it gets, so send that to /dev/null'
+	sys.stdout = open(os.devnull, 'w')
+	async_example.backends[backend]('localhost', port)
+
+def wait_for_port(port, timeout=5):
+	deadline = time.monotonic() + timeout
+	while True:
+		try:
+			socket.create_connection(('localhost', port)).close()
+			return
+		except ConnectionRefusedError:
+			if time.monotonic() > deadline:
+				raise
+			time.sleep(0.05)
+
+def benchmark(backend, port, connections, duration, depth):
+	server = Process(target=serve, args=(backend, port))
+	server.start()
+	try:
+		wait_for_port(port)
+		return loadgen.run('localhost', port, connections, duration, depth=depth)
+	finally:
+		server.terminate()
+		server.join()
+
+def backpressure(backend, port, lines=20000, width=1000, timeout=30):
+	'Pipeline far more output than high_water without reading any, then read it all. True if every reply arrives'
+	server = Process(target=serve, args=(backend, port))
+	server.start()
+	try:
+		wait_for_port(port)
+		sock = socket.socket()
+		sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 16)	# Small, so the replies back up in the server
+		sock.connect(('localhost', port))
+		sock.settimeout(timeout)
+		sender = threading.Thread(target=sock.sendall, args=((b'x' * width + b'\r\n') * lines,), daemon=True)
+		sender.start()
+		time.sleep(1)	# Let the session go over high_water and stop reading
+		replies = sock.makefile('rb')
+		received = 0
+		try:
+			while received <= lines and replies.readline():	# The welcome, then a reply per line
+				received += 1
+		except (socket.timeout, ConnectionError):
+			pass	# Stalled, or the server died
+		sock.close()
+		return received == lines + 1 and server.is_alive()
+	finally:
+		server.terminate()
+		server.join()
+
+if __name__ == '__main__':
+	args = list(map(int, sys.argv[1:4]))
+	connections, duration, depth = args + [100, 5, 16][len(args):]
+	results = {}
+	for port, backend in enumerate(async_example.backends, 9700):
+		results[backend] = report = benchmark(backend, port, connections, duration, depth)
+		print('%-8s %10d lines/s   p50 %8.3f ms   p99 %8.3f ms' % (backend, report['throughput'],
+			report['latency_ms']['p50'], report['latency_ms']['p99']))
+	for port, backend in enumerate(async_example.backends, 9710):
+		results[backend]['backpressure_correct'] = backpressure(backend, port)
+	print(json.dumps({'connections': connections, 'seconds': duration, 'depth': depth, 'results': results}))
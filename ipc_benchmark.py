@@ -0,0 +1,172 @@
+#!/usr/bin/python3
+
+"""
+Round-trip latency and one-way throughput of the ways two processes can
+talk: Pipe, Queue, SimpleQueue, a raw socketpair and a shared-memory ring.
+
+For each transport and message size (8 bytes to 16 MB by default) a child
+process echoes messages back to measure round trips, then swallows a
+stream of them to measure throughput. Transports that can carry raw bytes
+run twice: once sending a tuple wrapping the bytes through pickle
+(send/put), once with send_bytes. Prints a summary table and writes every number as JSON.
+
+Usage: ./ipc_benchmark.py [--sizes 8 4096 ...] [--transports pipe ring ...] [--json ipc.json]
+"""
+import argparse, json, pickle, socket, struct, time
+from multiprocessing import Pipe, Process, Queue, SimpleQueue
+
+from shm_ring import RingPipe
+
+length = struct.Struct('Q')
+
+class QueueEnd:
+	'One side of a pair of queues, which only carry pickled objects'
+	def __init__(self, inbox, outbox):
+		self.inbox, self.outbox = inbox, outbox
+
+	def send(self, obj):
+		self.outbox.put(obj)
+
+	def recv(self):
+		return self.inbox.get()
+
+	def close(self):
+		self.outbox.close()
+
+class SocketEnd:
+	'Length-prefixed messages over one end of a socketpair'
+	def __init__(self, sock):
+		self.sock = sock
+
+	def send_bytes(self, data):
+		self.sock.sendall(length.pack(len(data)))
+		self.sock.sendall(data)
+
+	def recv_exactly(self, n):
+		buf = bytearray(n)
+		view = memoryview(buf)
+		got = 0
+		while got < n:
+			got += self.sock.recv_into(view[got:])
+		return buf
+
+	def recv_bytes(self):
+		return self.recv_exactly(length.unpack(self.recv_exactly(length.size))[0])
+
+	def send(self, obj):
+		self.send_bytes(pickle.dumps(obj, pickle.HIGHEST_PROTOCOL))
+
+	def recv(self):
+		return pickle.loads(self.recv_bytes())
+
+	def close(self):
+		self.sock.close()
+
+def pipe():
+	return Pipe()
+
+def queue():
+	a, b = Queue(), Queue()
+	return QueueEnd(a, b), QueueEnd(b, a)
+
+def simple_queue():
+	a, b = SimpleQueue(), SimpleQueue()
+	return QueueEnd(a, b), QueueEnd(b, a)
+
+def socket_pair():
+	a, b = socket.socketpair()
+	return SocketEnd(a), SocketEnd(b)
+
+transports = {
+	'pipe': (pipe, ('pickle', 'bytes')),
+	'queue': (queue, ('pickle',)),
+	'simple_queue': (simple_queue, ('pickle',)),
+	'socketpair': (socket_pair, ('pickle', 'bytes')),
+	'ring': (RingPipe, ('pickle', 'bytes')),
+}
+
+def echo(end, mode, count):
+	'Child: send every message straight back'
+	send, recv = (end.send, end.recv) if mode == 'pickle' else (end.send_bytes, end.recv_bytes)
+	for i in range(count):
+		send(recv())
+
+def sink(end, mode, count):
+	'Child: take count messages, then acknowledge them all at once'
+	recv = end.recv if mode == 'pickle' else end.recv_bytes
+	for i in range(count):
+		recv()
+	end.send_bytes(b'!') if mode == 'bytes' else end.send(b'!')
+
+def counts(size):
+	'Round trips and stream length for a size: plenty of small messages, a handful of big ones'
+	return max(5, min(2000, (64 << 20) // size)), max(5, min(20000, (256 << 20) // size))
+
+def measure(make, mode, size):
+	rounds, stream = counts(size)
+	message = bytes(size) if mode == 'bytes' else (bytes(size),)	# A tuple, so no transport can skip pickling it
+	parent, child = make()
+	send, recv = (parent.send, parent.recv) if mode == 'pickle' else (parent.send_bytes, parent.recv_bytes)
+	p = Process(target=echo, args=(child, mode, rounds))
+	p.start()
+	times = []
+	for i in range(rounds):
+		start = time.perf_counter()
+		send(message)
+		recv()
+		times.append(time.perf_counter() - start)
+	p.join()
+	p = Process(target=sink, args=(child, mode, stream))
+	p.start()
+	start = time.perf_counter()
+	for i in range(stream):
+		send(message)
+	recv()
+	seconds = time.perf_counter() - start
+	p.join()
+	parent.close()
+	child.close()
+	times.sort()
+	return {
+		'rtt_p50_us': round(times[len(times) // 2] * 1e6, 1),
+		'rtt_p99_us': round(times[min(int(len(times) * 0.99), len(times) - 1)] * 1e6, 1),
+		'messages_per_sec': round(stream / seconds),
+		'mb_per_sec': round(stream * size / seconds / 1e6, 1),
+	}
+
+def benchmark(sizes, names):
+	results = []
+	for name in names:
+		make, modes = transports[name]
+		for mode in modes:
+			for size in sizes:
+				results.append(dict(transport=name, mode=mode, size=size, **measure(make, mode, size)))
+	return results
+
+def label(size):
+	for unit, scale in (('M', 1 << 20), ('K', 1 << 10)):
+		if size >= scale and size % scale == 0:
+			return '%d%s' % (size // scale, unit)
+	return str(size)
+
+def table(results, sizes, field):
+	rows = {}
+	for r in results:
+		rows.setdefault('%s/%s' % (r['transport'], r['mode']), {})[r['size']] = r[field]
+	lines = ['%-20s' % field + ''.join('%10s' % label(size) for size in sizes)]
+	for row, values in rows.items():
+		lines.append('%-20s' % row + ''.join('%10s' % values.get(size, '') for size in sizes))
+	return '\n'.join(lines)
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+	parser.add_argument('--sizes', type=int, nargs='+', default=[8 << (3 * i) for i in range(8)])
+	parser.add_argument('--transports', nargs='+', default=list(transports), choices=list(transports))
+	parser.add_argument('--json', default='ipc_benchmark.json', help='where to write every measurement')
+	args = parser.parse_args()
+	results = benchmark(args.sizes, args.transports)
+	print(table(results, args.sizes, 'rtt_p50_us'))
+	print()
+	print(table(results, args.sizes, 'mb_per_sec'))
+	with open(args.json, 'w') as f:
+		json.dump({'sizes': args.sizes, 'results': results}, f, indent=2)
@@ -0,0 +1,145 @@
+#!/usr/bin/python3
+
+"""
+Load generator for the line protocol served by async_example.py.
+
+Opens many concurrent client connections, sends nbcaser commands
+('title', 'upper', free text and a final 'quit') back to back or at a
+fixed rate per connection, optionally pipelined, and prints a JSON
+report: connect rate, throughput and p50/p99/p999 round-trip latency.
+
+With a rate, latency is measured from when each line was due to be
+sent rather than when it went out, so a stalled server can't hide its
+stalls by slowing the client down (coordinated omission).
+
+Usage: ./loadgen.py --port 9600 --connections 2000 --duration 10 --rate 5 --depth 4 --processes 2
+"""
+import argparse, asyncio, itertools, json, resource, time
+from collections import deque
+from multiprocessing import Pool
+
+# Every command gets exactly one reply line, including mode switches and quit
+commands = [b'hello world', b'title', b'the quick brown fox', b'upper', b'jumps over the lazy dog']
+
+def raise_fd_limit():
+	'Each connection is a file descriptor; allow as many as the hard limit permits'
+	soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+	resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+async def drive(reader, writer, deadline, rate, depth, latencies):
+	'One client: batches of depth lines, paced at rate lines/s or sent as soon as the last batch is answered'
+	script = itertools.cycle([command + b'\r\n' for command in commands])
+	in_flight = deque()	# Due time of every unanswered line
+	idle = asyncio.Event()
+	async def receive():
+		while await reader.readline():
+			latencies.append(time.perf_counter() - in_flight.popleft())
+			if not in_flight:
+				idle.set()
+	receiver = asyncio.create_task(receive())
+	interval = depth / rate if rate else 0
+	due = time.perf_counter()
+	while due < deadline and not receiver.done():
+		if rate:
+			await asyncio.sleep(due - time.perf_counter())
+		else:
+			due = time.perf_counter()
+		idle.clear()
+		in_flight.extend([due] * depth)
+		writer.write(b''.join(itertools.islice(script, depth)))
+		if not rate:
+			await idle.wait()
+		due += interval
+	if in_flight:
+		await asyncio.wait_for(idle.wait(), 10)
+	in_flight.append(time.perf_counter())
+	writer.write(b'quit\r\n')
+	await asyncio.wait_for(receiver, 10)	# The server hangs up after answering quit
+	writer.close()
+
+async def load(host, port, connections, duration, rate, depth, connect_concurrency):
+	'Connect every client, then drive them all for duration seconds. Returns raw measurements'
+	raise_fd_limit()
+	gate = asyncio.Semaphore(connect_concurrency)
+	connect_times, latencies, errors = [], [], 0
+	async def connect():
+		nonlocal errors
+		async with gate:
+			start = time.perf_counter()
+			try:
+				reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), 10)
+				if not await asyncio.wait_for(reader.readline(), 10):	# Welcome banner
+					raise ConnectionRefusedError('server hung up')	# Turned away by admission control
+			except (OSError, asyncio.TimeoutError):
+				errors += 1
+				return None
+			connect_times.append(time.perf_counter() - start)
+			return reader, writer
+	start = time.perf_counter()
+	clients = [client for client in await asyncio.gather(*(connect() for i in range(connections))) if client]
+	connect_seconds = time.perf_counter() - start
+	start = time.perf_counter()
+	outcomes = await asyncio.gather(*(drive(reader, writer, start + duration, rate, depth, latencies)
+		for reader, writer in clients), return_exceptions=True)
+	errors += sum(isinstance(outcome, Exception) for outcome in outcomes)
+	return {
+		'connected': len(clients),
+		'errors': errors,
+		'connect_seconds': connect_seconds,
+		'connect_times': connect_times,
+		'seconds': time.perf_counter() - start,
+		'latencies': latencies,
+	}
+
+def load_process(args):
+	return asyncio.run(load(*args))
+
+def percentiles(samples, points=(0.50, 0.99, 0.999)):
+	'Milliseconds at each percentile point, keyed like p50, p99, p999'
+	ordered = sorted(samples) or [0]
+	report = {}
+	for p in points:
+		key = 'p' + ('%g' % (p * 100)).replace('.', '')
+		report[key] = round(ordered[min(int(len(ordered) * p), len(ordered) - 1)] * 1000, 3)
+	report['max'] = round(ordered[-1] * 1000, 3)
+	return report
+
+def run(host='localhost', port=9600, connections=1000, duration=10, rate=None, depth=1, processes=1,
+		connect_concurrency=256):
+	'Generate load from one or more processes and merge their measurements into one report'
+	shares = [connections // processes + (i < connections % processes) for i in range(processes)]
+	jobs = [(host, port, share, duration, rate, depth, connect_concurrency) for share in shares]
+	if processes == 1:
+		parts = [load_process(jobs[0])]
+	else:
+		with Pool(processes) as pool:
+			parts = pool.map(load_process, jobs)
+	latencies = [sample for part in parts for sample in part['latencies']]
+	connect_times = [sample for part in parts for sample in part['connect_times']]
+	connected = sum(part['connected'] for part in parts)
+	seconds = max(part['seconds'] for part in parts)
+	return {
+		'connections': connections,
+		'connected': connected,
+		'errors': sum(part['errors'] for part in parts),
+		'connect_rate': round(connected / max(max(part['connect_seconds'] for part in parts), 1e-9)),
+		'connect_ms': percentiles(connect_times),
+		'lines': len(latencies),
+		'seconds': round(seconds, 3),
+		'throughput': round(len(latencies) / seconds),
+		'latency_ms': percentiles(latencies),
+	}
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+	parser.add_argument('--host', default='localhost')
+	parser.add_argument('--port', type=int, default=9600)
+	parser.add_argument('--connections', type=int, default=1000)
+	parser.add_argument('--duration', type=float, default=10, help='seconds of load after everyone connects')
+	parser.add_argument('--rate', type=float, help='lines per second per connection (default: as fast as answered)')
+	parser.add_argument('--depth', type=int, default=1, help='lines pipelined per batch')
+	parser.add_argument('--processes', type=int, default=1, help='client processes sharing the connections')
+	parser.add_argument('--connect-concurrency', type=int, default=256, help='connection attempts in flight')
+	args = parser.parse_args()
+	print(json.dumps(run(args.host, args.port, args.connections, args.duration, args.rate, args.depth,
+		args.processes, args.connect_concurrency), indent=2))
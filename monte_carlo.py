@@ -0,0 +1,88 @@
+#!/usr/bin/python3
+
+"""
+Monte Carlo estimate of pi, vectorized with NumPy and spread over a Pool.
+
+compute_pi in multiprocessing_python.py draws one point per loop turn and
+its Pool version forks workers that may all start from the same random
+state. Here every task draws its points in bounded NumPy batches from its
+own stream (SeedSequence.spawn), tests x*x + y*y <= 1 without a sqrt, and
+sends back integer counts that are summed exactly. The run stops early once
+the standard error of the estimate reaches the target. Results are taken
+in task order, so a given seed gives the same answer for any worker count,
+with or without a target.
+
+Usage: ./monte_carlo.py [samples] [workers] [target standard error]
+"""
+import json, math, os, sys, time
+from multiprocessing import Pool
+
+import numpy as np
+
+batch_size = 1 << 20	# Points per NumPy call: two arrays of doubles, 16 MB per worker
+task_samples = 1 << 24	# Points per task: how often the parent gets to check the error
+
+def count_inside(seed, n):
+	'Points out of n uniform draws in the unit square that land inside the quarter circle'
+	rng = np.random.default_rng(seed)
+	x = np.empty(min(n, batch_size))
+	y = np.empty(min(n, batch_size))
+	inside = 0
+	start = time.perf_counter()
+	for done in range(0, n, batch_size):
+		m = min(batch_size, n - done)
+		bx, by = x[:m], y[:m]
+		rng.random(out=bx)
+		rng.random(out=by)
+		bx *= bx	# In place: no temporaries per batch
+		by *= by
+		bx += by
+		inside += int(np.count_nonzero(bx <= 1.0))
+	return inside, n, time.perf_counter() - start
+
+def count_task(args):
+	return count_inside(*args)
+
+def estimate(inside, n):
+	'pi estimate and its standard error from a hit count'
+	p = inside / n
+	return 4 * p, 4 * math.sqrt(p * (1 - p) / n)
+
+def compute_pi(samples=10**8, workers=None, target=None, seed=None):
+	'Estimate pi from up to samples points, stopping once the standard error is at most target'
+	if samples < 1:
+		raise ValueError('samples must be at least 1, got %r' % samples)
+	workers = workers or os.cpu_count()
+	sizes = [task_samples] * (samples // task_samples) + [samples % task_samples] * bool(samples % task_samples)
+	seeds = np.random.SeedSequence(seed).spawn(len(sizes))	# Independent, reproducible stream per task
+	inside = n = tasks = 0
+	busy = 0	# Seconds the workers spent drawing, summed
+	start = time.perf_counter()
+	with Pool(workers) as pool:
+		# In task order, so an early stop always covers the same tasks and the answer depends only on the seed
+		for hits, drawn, seconds in pool.imap(count_task, zip(seeds, sizes)):
+			inside += hits
+			n += drawn
+			busy += seconds
+			tasks += 1
+			if target and estimate(inside, n)[1] <= target:
+				break	# Leaving the with block terminates the tasks still running
+	elapsed = time.perf_counter() - start
+	pi_estimate, stderr = estimate(inside, n)
+	return {
+		'pi': pi_estimate,
+		'error': pi_estimate - math.pi,
+		'stderr': stderr,
+		'samples': n,
+		'tasks': tasks,
+		'stopped_early': n < samples,
+		'seconds': round(elapsed, 3),
+		'samples_per_sec': round(n / elapsed),
+		'samples_per_sec_per_core': round(n / busy),
+	}
+
+if __name__ == '__main__':
+	samples = int(float(sys.argv[1])) if len(sys.argv) > 1 else 10**8
+	workers = int(sys.argv[2]) if len(sys.argv) > 2 else None
+	target = float(sys.argv[3]) if len(sys.argv) > 3 else None
+	print(json.dumps(compute_pi(samples, workers, target), indent=2))
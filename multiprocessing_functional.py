@@ -22,22 +22,25 @@ scientists = (
 	Scientist(name='Sally Ride', field='physics', born=1951, nobel=False),
 )
 
-pprint(scientists)
-print()
-
+# record_batch.py runs this transform over columns in shared memory, a row range per task
 def transform(x):
 	print(f'Process {os.getpid()} working record {x.name}')
 	time.sleep(1)
 	result = {'name': x.name, 'age': 2017 - x.born}
 	print(f'{os.getpid()} done processing record {x.name}')
 	return result
-start = time.time()
-pool = multiprocessing.Pool()
-result = pool.map(transform, scientists)
-end = time.time()
 
-print(f'\nTime to complete: {end - start:.2f}s\n')
-pprint(result)
+if __name__ == '__main__':
+	pprint(scientists)
+	print()
+
+	start = time.time()
+	with multiprocessing.Pool() as pool:	# For many jobs in one process, warm_pool.WarmPool keeps the workers
+		result = pool.map(transform, scientists)
+	end = time.time()
+
+	print(f'\nTime to complete: {end - start:.2f}s\n')
+	pprint(result)
 
 #result = tuple(map(
 #	transform,
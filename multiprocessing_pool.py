@@ -2,6 +2,10 @@
 
 from multiprocessing import Pool
 import time
+
+from adaptive_pool import adaptive_map
+from parallel_map import parallel_map
+
 def squared(n):	
 	return n * n
 
@@ -19,4 +23,11 @@ if __name__ == '__main__':
 		result.append(squared(x))
 	print("Serial processing took: ", time.time() - t2)
 
+	t3 = time.time()
+	with Pool(processes=3) as p:
+		result = adaptive_map(p, squared, range(10000), workers=3)	# Chunks grow until pickling stops dominating
+	print("Pool with adaptive chunks took: ", time.time() - t3)
 
+	t4 = time.time()
+	result = parallel_map(squared, range(10000), verbose=True)	# Measures the overheads first; picks serial here
+	print("parallel_map took: ", time.time() - t4)
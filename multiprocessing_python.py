@@ -59,6 +59,7 @@ if __name__ == '__main__':
 
 """
 # With pool of service workers
+# (monte_carlo.py does this with NumPy batches and an independent random stream per task)
 """
 from random import random
 from math import sqrt, pi
@@ -116,6 +117,7 @@ if __name__ == '__main__':
 # Must pass object to child process. 
 
 # Pipe example
+# (shm_ring.RingPipe() is a drop-in for Pipe() here: a shared-memory ring per direction, no pickling of bytes)
 """
 import os
 from multiprocessing import Process, Pipe
@@ -138,19 +140,13 @@ if __name__ == '__main__':
 	proc.join()
 """
 # Queue example
+# (pipeline.py: the same shape with batched items, N workers and a bounded results queue)
 """
-import math
 import random
 from multiprocessing import Process, Queue
 from os import getpid
 
-def is_prime(n):
-	if n % 2 == 0:
-		return False
-	for i in range(3, int(math.sqrt(n)+1), 2):
-		if n % i == 0:
-			return False
-	return True
+from primes import is_prime	# Sieve lookup, small-prime gcd, then deterministic Miller-Rabin
 
 def process_main(q):
 	while True:
@@ -204,6 +200,7 @@ if __name__ == '__main__':
 	print(v.value)
 """
 # Avoid locks unless absolutely necessary.
+# (sharded_counter.py: a counter where each process adds to its own padded slot, no lock at all)
 # Synchronization - standard tools available and multiprocessing uses the same API as threading.
 
 # Manager class
@@ -212,6 +209,7 @@ if __name__ == '__main__':
 # Offers Value and Array
 # Implements all synchronization classes
 # Can be connected to remotely
+# (shm_dict.py: a fixed-capacity dict in shared memory, no server round trip per access)
 """
 from time import sleep
 from os import getpid
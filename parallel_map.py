@@ -0,0 +1,229 @@
+#!/usr/bin/python3
+
+"""
+map() that decides for itself whether to run serially, on a ThreadPool or
+on a process Pool, and with how many workers.
+
+multiprocessing_pool.py shows the trap: Pool.map(squared, ...) is far
+slower than a plain loop, because starting workers and pickling every item
+costs more than squaring it. parallel_map() measures those costs once per
+machine (process and thread start-up, per-task round trips, bytes through
+pickle and a pipe) and caches them on disk. For each call it times the
+first few items, and keeps their results. That gives the work per item,
+how much of it holds the GIL (CPU time against wall time) and how many
+bytes each item and result pickle to. It then estimates the run time of
+every option, Amdahl-style: the fixed and per-item overheads plus, for
+threads, the CPU share of the work stay serial, and only the rest divides
+by the worker count. The cheapest estimate wins, so serial is the default
+whenever the overheads outweigh what the workers could save.
+
+Usage: ./parallel_map.py [--recalibrate]
+"""
+import json, math, multiprocessing, os, pickle, platform, sys, time
+from collections import namedtuple
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+
+cache_path = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'parallel_map.json')
+sample_seconds = 0.05	# Time to spend sampling the function before choosing
+sample_items = 8	# ...or this many items, whichever comes first
+cpu_bound_share = 0.9	# CPU time above this share of wall time is measurement noise away from all of it
+timer_floor = 1e-3	# Samples shorter than this in total are all timer overhead: assume CPU-bound
+chunks_per_worker = 4
+worker_counts = (2, 4, 8, 16, 32, 64)	# Candidates, plus the CPU count
+max_threads = 64
+
+calibrations = {}	# { cache path : calibration } already loaded or measured by this process
+
+Plan = namedtuple('Plan', ['kind', 'workers', 'chunksize', 'seconds', 'estimates'])
+
+### Calibration ###
+
+def noop(x):
+	return x
+
+def machine():
+	'Cache key: calibrations are only valid for the same host, CPU count and interpreter'
+	return '%s/%d/%s' % (platform.node(), os.cpu_count(), platform.python_version())
+
+def measure_pool(make, workers, tasks=2000, payload=1 << 20, payload_tasks=20):
+	'(start-up seconds per worker, seconds per task round trip, seconds per byte of item and result) for a pool type'
+	start = time.perf_counter()
+	with make(workers) as pool:
+		pool.map(noop, range(workers), chunksize=1)	# Every worker up and answering
+		startup = (time.perf_counter() - start) / workers
+		start = time.perf_counter()
+		pool.map(noop, range(tasks), chunksize=1)
+		task = (time.perf_counter() - start) / tasks
+		data = bytes(payload)
+		start = time.perf_counter()
+		pool.map(noop, [data] * payload_tasks, chunksize=1)
+		per_byte = max((time.perf_counter() - start) / payload_tasks - task, 0) / (2 * payload)	# There and back
+	return startup, task, per_byte
+
+def can_fork():
+	return not multiprocessing.current_process().daemon	# Pool workers are daemonic and can't have children
+
+def calibrate(processes=True):
+	'Measure the fixed costs of this machine. Takes about a second. Without processes, their costs are None'
+	workers = max(os.cpu_count(), 2)
+	process_start, process_task, process_byte = measure_pool(Pool, workers) if processes else (None, None, None)
+	thread_start, thread_task = measure_pool(ThreadPool, 4)[:2]	# Threads share memory: nothing is pickled
+	return {
+		'cpus': os.cpu_count(),
+		'process_start': process_start,	# Seconds to bring up one worker process
+		'process_task': process_task,	# Seconds of parent-side overhead per task sent to a process
+		'process_byte': process_byte,	# Seconds per byte pickled, piped and unpickled
+		'thread_start': thread_start,
+		'thread_task': thread_task,
+		'calibrated': time.time(),
+	}
+
+def load_calibration(path=cache_path, refresh=False):
+	'''This machine\'s calibration from the cache file, measured and saved on first use. In a daemonic process
+	only threads are measured, and that partial calibration is kept in memory rather than cached'''
+	if path in calibrations and not refresh:
+		return calibrations[path]
+	try:
+		with open(path) as f:
+			machines = json.load(f)
+	except (OSError, ValueError):
+		machines = {}
+	if refresh or machine() not in machines:
+		if not can_fork():
+			calibrations[path] = calibrate(processes=False)
+			return calibrations[path]
+		machines[machine()] = calibrate()
+		try:
+			os.makedirs(os.path.dirname(path), exist_ok=True)
+			with open(path + '.tmp', 'w') as f:
+				json.dump(machines, f, indent=2)
+			os.replace(path + '.tmp', path)	# Concurrent first runs can't leave a torn file
+		except OSError:
+			pass	# Unwritable cache: use the measurement for this process only
+	calibrations[path] = machines[machine()]
+	return calibrations[path]
+
+### Sampling and the cost model ###
+
+def picklable(obj):
+	try:
+		return len(pickle.dumps(obj, pickle.HIGHEST_PROTOCOL))
+	except Exception:	# Lambdas, closures, open files, locks...
+		return None
+
+def sample(fn, items):
+	'Run fn on the first few items. Returns (results, wall seconds per item, CPU share, pickled bytes per item or None)'
+	results = []
+	wall = cpu = 0
+	size = 0 if picklable(fn) is not None else None
+	while len(results) < min(sample_items, len(items)) and wall < sample_seconds:
+		item = items[len(results)]
+		start, start_cpu = time.perf_counter(), time.thread_time()
+		result = fn(item)
+		cpu += time.thread_time() - start_cpu
+		wall += time.perf_counter() - start
+		results.append(result)
+		if size is not None:
+			sizes = picklable(item), picklable(result)
+			size = None if None in sizes else size + sum(sizes)
+	n = max(len(results), 1)
+	cpu_share = 1 if wall < timer_floor or cpu / wall > cpu_bound_share else cpu / wall
+	return results, wall / n, cpu_share, None if size is None else size / n
+
+def estimate(calibration, n, work, cpu_share, size, kind, workers):
+	'Seconds to map n more items of work seconds each, cpu_share of it holding the GIL'
+	if kind == 'serial':
+		return n * work
+	chunks = min(n, workers * chunks_per_worker)
+	if kind == 'thread':
+		# Amdahl: the CPU part is serialised by the GIL, only waiting overlaps
+		return (workers * calibration['thread_start'] + chunks * calibration['thread_task']
+			+ n * work * cpu_share + n * work * (1 - cpu_share) / workers)
+	# Processes: the parent pickles every item and result alone; CPU work spreads over at most cpus workers
+	return (workers * calibration['process_start'] + chunks * calibration['process_task'] + n * size * calibration['process_byte']
+		+ n * work * cpu_share / min(workers, calibration['cpus']) + n * work * (1 - cpu_share) / workers)
+
+def choose(calibration, n, work, cpu_share, size):
+	'Cheapest Plan for n items, given the sampled costs'
+	counts = sorted(set(worker_counts) | {calibration['cpus']})
+	options = [('serial', 1)] + [('thread', w) for w in counts if 1 < w <= max_threads]
+	# Daemonic pool workers can't have children, and unpicklable functions or items can't be sent
+	if size is not None and can_fork() and calibration['process_start'] is not None:
+		options += [('process', w) for w in counts if 1 < w <= 4 * calibration['cpus']]
+	estimates = {'%s/%d' % option: estimate(calibration, n, work, cpu_share, size, *option) for option in options}
+	kind, workers = min(options, key=lambda option: estimates['%s/%d' % option])
+	chunksize = max(1, math.ceil(n / (workers * chunks_per_worker)))
+	return Plan(kind, workers, chunksize, estimates['%s/%d' % (kind, workers)], estimates)
+
+def plan(fn, iterable, calibration=None):
+	'(Plan, items, results for the sampled items) without running the rest'
+	items = list(iterable)
+	calibration = calibration or load_calibration()
+	results, work, cpu_share, size = sample(fn, items)
+	return choose(calibration, len(items) - len(results), work, cpu_share, size), items, results
+
+def parallel_map(fn, iterable, calibration=None, verbose=False):
+	'Like list(map(fn, iterable)), run whichever way the cost model expects to be fastest'
+	chosen, items, results = plan(fn, iterable, calibration)
+	rest = items[len(results):]
+	if verbose:
+		print('parallel_map: %s x%d, chunksize %d, ~%.3fs' % chosen[:4], file=sys.stderr)
+	if chosen.kind == 'serial' or not rest:
+		return results + [fn(item) for item in rest]
+	make = Pool if chosen.kind == 'process' else ThreadPool
+	with make(chosen.workers) as pool:
+		return results + pool.map(fn, rest, chosen.chunksize)
+
+### Benchmark ###
+
+def squared(n):
+	return n * n
+
+def spin(n):
+	'CPU-bound: holds the GIL throughout'
+	total = 0
+	for i in range(n):
+		total += i * i
+	return total
+
+def wait(seconds):
+	'I/O-bound stand-in: releases the GIL while it waits'
+	time.sleep(seconds)
+	return seconds
+
+def run(fn, items, kind, workers):
+	start = time.perf_counter()
+	if kind == 'serial':
+		list(map(fn, items))
+	else:
+		with (Pool if kind == 'process' else ThreadPool)(workers) as pool:
+			pool.map(fn, items, max(1, math.ceil(len(items) / (workers * chunks_per_worker))))
+	return time.perf_counter() - start
+
+def benchmark(calibration):
+	'Chosen plan against every fixed strategy, on tiny, CPU-bound and I/O-bound tasks'
+	cpus = calibration['cpus']
+	workloads = {
+		'squared': (squared, range(10**5)),
+		'spin': (spin, [200000] * 64),
+		'wait': (wait, [0.01] * 200),
+	}
+	report = {}
+	for name, (fn, items) in workloads.items():
+		items = list(items)
+		chosen = plan(fn, items, calibration)[0]
+		start = time.perf_counter()
+		parallel_map(fn, items, calibration)
+		report[name] = {
+			'chosen': '%s/%d' % (chosen.kind, chosen.workers),
+			'parallel_map': round(time.perf_counter() - start, 3),
+			'serial': round(run(fn, items, 'serial', 1), 3),
+			'thread/%d' % max(cpus, 8): round(run(fn, items, 'thread', max(cpus, 8)), 3),
+			'process/%d' % max(cpus, 2): round(run(fn, items, 'process', max(cpus, 2)), 3),
+		}
+	return report
+
+if __name__ == '__main__':
+	calibration = load_calibration(refresh='--recalibrate' in sys.argv)
+	print(json.dumps({'calibration': calibration, 'seconds': benchmark(calibration)}, indent=2))
@@ -0,0 +1,154 @@
+#!/usr/bin/python3
+
+"""
+Producer -> worker processes -> collector pipeline with batched queues.
+
+The Queue example in multiprocessing_python.py puts one integer per q.put()
+for a single consumer, so every item pays for a pickle, a pipe write and a
+lock. Here a producer thread cuts the input into batches for a bounded work
+queue. N worker processes each apply the function to whole batches and stop
+on a sentinel of their own. Results come back, a batch at a time, on a
+bounded results queue, so a slow collector holds up the workers instead of
+piling results up in memory.
+
+Usage: ./pipeline.py [items]
+"""
+import itertools, json, os, queue, random, sys, threading, time
+from multiprocessing import Process, Queue
+
+from primes import is_prime
+
+def work(fn, tasks, results):
+	'Worker process: apply fn to each batch until the sentinel, then report busy time'
+	busy = 0
+	while True:
+		task = tasks.get()
+		if task is None:
+			results.put((None, busy, None))
+			return
+		seq, items = task
+		start = time.perf_counter()
+		try:
+			out, error = [fn(item) for item in items], None
+		except Exception as e:
+			out, error = None, e
+		busy += time.perf_counter() - start
+		results.put((seq, out, error))
+
+class Pipeline:
+	'Runs fn over items in batches on worker processes. metrics describes the last run'
+
+	def __init__(self, fn, workers=None, batch_size=100, depth=None):
+		self.fn = fn
+		self.workers = workers or os.cpu_count()
+		self.batch_size = batch_size
+		self.depth = depth or 2 * self.workers	# Result batches allowed to wait for the collector
+		self.metrics = {}
+
+	def produce(self, items, tasks, stop):
+		'Producer thread: batch the input, then one sentinel per worker'
+		blocked = 0
+		try:
+			it = iter(items)
+			for seq in itertools.count():
+				batch = list(itertools.islice(it, self.batch_size))
+				if not batch:
+					break
+				blocked += self.put(tasks, (seq, batch), stop)
+		except Exception as e:
+			self.error = e	# Raised by the collector once the workers have stopped
+		for i in range(self.workers):
+			blocked += self.put(tasks, None, stop)
+		self.metrics['producer_blocked'] = round(blocked, 3)
+
+	def put(self, tasks, task, stop):
+		'Put, waiting while the work queue is full unless the run is abandoned. Returns seconds waited'
+		start = time.perf_counter()
+		while not stop.is_set():
+			try:
+				tasks.put(task, timeout=0.1)
+				break
+			except queue.Full:
+				pass
+		return time.perf_counter() - start
+
+	def run(self, items, ordered=True):
+		'Yield fn(item) for every item: in input order, or as batches finish when not ordered'
+		self.error = None
+		tasks, results = Queue(2 * self.workers), Queue(self.depth)
+		stop = threading.Event()
+		workers = [Process(target=work, args=(self.fn, tasks, results)) for i in range(self.workers)]
+		for p in workers:
+			p.start()
+		producer = threading.Thread(target=self.produce, args=(items, tasks, stop), daemon=True)
+		producer.start()
+		pending = {}	# { batch seq : results } that finished ahead of an earlier batch
+		next_seq = done = count = batches = 0
+		idle, busy = 0, []
+		start = time.perf_counter()
+		try:
+			while done < self.workers:
+				waited = time.perf_counter()
+				seq, out, error = results.get()
+				idle += time.perf_counter() - waited
+				if seq is None:	# A worker took its sentinel
+					done += 1
+					busy.append(round(out, 3))
+					continue
+				if error is not None:
+					raise error
+				batches += 1
+				count += len(out)
+				if not ordered:
+					yield from out
+					continue
+				pending[seq] = out
+				while next_seq in pending:
+					yield from pending.pop(next_seq)
+					next_seq += 1
+			producer.join()
+			if self.error is not None:
+				raise self.error
+			for p in workers:
+				p.join()
+		finally:
+			stop.set()
+			for p in workers:
+				if p.is_alive():	# Abandoned early or failed: don't wait for the rest of the input
+					p.terminate()
+					p.join()
+			seconds = time.perf_counter() - start
+			self.metrics.update({
+				'items': count,
+				'batches': batches,
+				'batch_size': self.batch_size,
+				'workers': self.workers,
+				'seconds': round(seconds, 3),
+				'items_per_sec': round(count / seconds) if seconds else 0,
+				'collector_idle': round(idle, 3),
+				'worker_busy': busy,
+			})
+
+	def map(self, items):
+		return list(self.run(items))
+
+### Benchmark ###
+
+def benchmark(items=20000, batch_sizes=(1, 10, 100, 1000), worker_counts=(1, 2, 4)):
+	'Items per second for each batch size and worker count, on primality tests'
+	candidates = [random.randint(0, 10**9) for i in range(items)]	# As in the Queue example
+	expected = list(map(is_prime, candidates))
+	report = {}
+	for workers in worker_counts:
+		for batch_size in batch_sizes:
+			p = Pipeline(is_prime, workers, batch_size)
+			assert p.map(candidates) == expected
+			report['workers=%d batch=%d' % (workers, batch_size)] = p.metrics
+	return report
+
+if __name__ == '__main__':
+	items = int(float(sys.argv[1])) if len(sys.argv) > 1 else 20000
+	report = benchmark(items)
+	for run, metrics in report.items():
+		print('%-22s %10d items/s' % (run, metrics['items_per_sec']))
+	print(json.dumps({'items': items, 'results': report}))
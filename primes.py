@@ -0,0 +1,144 @@
+#!/usr/bin/python3
+
+"""
+Primality testing for the Queue example and the pipeline benchmark.
+
+is_prime in multiprocessing_python.py divides by every odd number up to
+sqrt(n): about 15k divisions for a candidate near 1e9. It also says 1 is
+prime and 2 is not. Here small numbers are looked up in a sieve, most
+composites are caught by a gcd with the product of the small primes, and
+whatever is left goes through Miller-Rabin with the bases known to be
+exact for that size (every n below 3.3e24, which covers 64 bits). Larger
+n get the same bases and are only probable primes.
+
+is_prime_many() tests a whole batch, doing the small-prime stage with NumPy
+when it is installed. primes_between() sieves a dense range a segment at a
+time.
+
+Usage: ./primes.py [candidates]
+"""
+import itertools, json, math, random, sys, time
+
+try:
+	import numpy as np
+except ImportError:
+	np = None	# is_prime_many() falls back to one is_prime() call per candidate
+
+def sieve(n):
+	'Flags for 0..n-1: 1 where the index is prime'
+	flags = bytearray([1]) * n
+	flags[:2] = bytes(min(n, 2))
+	for p in range(2, math.isqrt(n - 1) + 1 if n > 1 else 0):
+		if flags[p]:
+			flags[p * p::p] = bytes(len(range(p * p, n, p)))
+	return flags
+
+sieve_limit = 1 << 16	# Anything smaller is a table lookup
+small_flags = sieve(sieve_limit)
+filter_primes = [p for p in range(256) if small_flags[p]]	# Tried before Miller-Rabin
+primorial = math.prod(filter_primes)
+
+# (bound, bases): Miller-Rabin with these bases is exact for every n below bound
+mr_bases = [
+	(2047, (2,)),
+	(1373653, (2, 3)),
+	(25326001, (2, 3, 5)),
+	(3215031751, (2, 3, 5, 7)),
+	(2152302898747, (2, 3, 5, 7, 11)),
+	(3474749660383, (2, 3, 5, 7, 11, 13)),
+	(341550071728321, (2, 3, 5, 7, 11, 13, 17)),
+	(3825123056546413051, (2, 3, 5, 7, 11, 13, 17, 19, 23)),
+	(318665857834031151167461, (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37)),
+	(3317044064679887385961981, (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41)),
+]
+
+def miller_rabin(n):
+	'Strong probable-prime test of odd n > 41, exact below 3.3e24'
+	for bound, bases in mr_bases:
+		if n < bound:
+			break
+	s = ((n - 1) & (1 - n)).bit_length() - 1	# n - 1 = d * 2**s with d odd
+	d = (n - 1) >> s
+	for a in bases:
+		x = pow(a, d, n)
+		if x == 1 or x == n - 1:
+			continue
+		for i in range(s - 1):
+			x = x * x % n
+			if x == n - 1:
+				break
+		else:
+			return False	# a witnesses that n is composite
+	return True
+
+def is_prime(n):
+	if n < sieve_limit:
+		return n >= 0 and small_flags[n] == 1
+	if math.gcd(n, primorial) != 1:
+		return False
+	return miller_rabin(n)
+
+def is_prime_many(candidates):
+	'is_prime() of every candidate. A NumPy array in gives a boolean array out'
+	if np is None or not len(candidates):
+		return [is_prime(n) for n in candidates]
+	as_array = isinstance(candidates, np.ndarray)
+	values = np.asarray(candidates)
+	if values.dtype.kind not in 'iu' or (values.dtype.kind == 'i' and (values < 0).any()):
+		return [is_prime(n) for n in candidates]	# Not integers, too big for 64 bits, or negative: as is_prime() would
+	values = values.astype(np.uint64)
+	result = np.zeros(len(values), dtype=bool)
+	small = values < sieve_limit
+	result[small] = np.frombuffer(small_flags, dtype=np.uint8)[values[small]].astype(bool)
+	maybe = ~small
+	for p in filter_primes:	# Vectorized stand-in for the gcd in is_prime()
+		maybe &= values % np.uint64(p) != 0
+	for i in np.flatnonzero(maybe):
+		result[i] = miller_rabin(int(values[i]))
+	return result if as_array else result.tolist()
+
+def primes_between(lo, hi, segment_size=1 << 18):
+	'Yield every prime p with lo <= p < hi, sieving segment_size numbers at a time'
+	base = [p for p, flag in enumerate(sieve(math.isqrt(max(hi - 1, 0)) + 1)) if flag]
+	for start in range(max(lo, 2), hi, segment_size):
+		stop = min(start + segment_size, hi)
+		flags = bytearray([1]) * (stop - start)
+		for p in base:
+			if p * p >= stop:
+				break
+			first = max(p * p, -(-start // p) * p)	# First multiple of p in the segment that is not p
+			flags[first - start::p] = bytes(len(range(first, stop, p)))
+		yield from itertools.compress(range(start, stop), flags)
+
+### Benchmark ###
+
+def trial_division(n):
+	'The original is_prime from the Queue example, wrong for 1 and 2'
+	if n % 2 == 0:
+		return False
+	for i in range(3, int(math.sqrt(n)+1), 2):
+		if n % i == 0:
+			return False
+	return True
+
+def benchmark(candidates=2000):
+	numbers = [random.randint(0, 10**9) for i in range(candidates)]
+	report = {'candidates': candidates}
+	tests = [('trial_division', lambda: list(map(trial_division, numbers))),
+		('is_prime', lambda: list(map(is_prime, numbers))),
+		('is_prime_many', lambda: is_prime_many(numbers))]
+	results = {}
+	for name, test in tests:
+		start = time.perf_counter()
+		results[name] = test()
+		report[name + '_per_sec'] = round(candidates / (time.perf_counter() - start))
+	report['agree'] = results['is_prime'] == results['is_prime_many'] == [trial_division(n) and n > 2 or n == 2 for n in numbers]
+	lo, hi = 10**9, 10**9 + 10**7
+	start = time.perf_counter()
+	report['primes_between_1e9_and_1e9+1e7'] = sum(1 for p in primes_between(lo, hi))
+	report['segmented_sieve_seconds'] = round(time.perf_counter() - start, 3)
+	return report
+
+if __name__ == '__main__':
+	candidates = int(float(sys.argv[1])) if len(sys.argv) > 1 else 2000
+	print(json.dumps(benchmark(candidates), indent=2))
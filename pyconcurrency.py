@@ -167,6 +167,7 @@ def sitesize(url):
 	page = u.read()
 	return url, len(page)
 """
+#range_download.sitesize(url, connections=10) does the channel bonding described above, with Range requests over keep-alive connections.
 #POOL OF PROCESSES
 import urllib.request
 from multiprocessing.pool import ThreadPool as Pool
@@ -194,6 +195,7 @@ def sitesize(url):
 		return url, len(page)
 pool = Pool(10)
 #imap_unordered is use to improve responsiveness.
+#async_fetch.imap_unordered(async_fetch.size, sites) fetches the same sites from one thread, reusing keep-alive connections per host.
 for result in pool.imap_unordered(sitesize, sites):
 	print(result)
 
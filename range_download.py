@@ -0,0 +1,140 @@
+#!/usr/bin/python3
+
+"""
+Download one large resource over several connections at once with HTTP
+Range requests ("channel bonding"), as the sitesize() docstring in
+pyconcurrency.py describes.
+
+On a high-latency link one TCP connection moves at most about a window
+per round trip, however fast the link is. bonded() first asks for the size
+with HEAD. If the server answers with a length and Accept-Ranges: bytes,
+it keeps connections requests in flight, each for the next unclaimed
+segment, and hands each segment to process(offset, data) as it arrives.
+A connection's segments are sized from its own measured throughput, so
+each request lasts about segment_seconds: long enough that the round trip
+per request is small, short enough to rebalance. Near the end they shrink
+so the connections finish together. Servers without range support, or
+without a length, get a single ordinary GET.
+
+Usage: ./range_download.py [--size 64] [--connections 1 2 4 8] [--latency 0.05] [--rate 2]
+"""
+import argparse, asyncio, json, math, os, time
+
+from async_fetch import Fetcher, StandInServer, stand_in_body
+
+segment_seconds = 1	# Aim for requests this long at each connection's observed rate
+min_segment = 64 << 10	# Bytes; also the size of each connection's first, probing request
+max_segment = 16 << 20
+
+class Segments:
+	'Hands out [start, stop) byte ranges of a resource, sized per connection'
+
+	def __init__(self, size, connections):
+		self.size, self.connections = size, connections
+		self.next = 0	# First byte not yet claimed
+		self.sizes = []	# Every segment handed out, for reports
+
+	def claim(self, rate):
+		'Next range for a connection moving rate bytes/s (None before it has measured one), or None when all are claimed'
+		remaining = self.size - self.next
+		if not remaining:
+			return None
+		n = min_segment if rate is None else min(max(int(rate * segment_seconds), min_segment), max_segment)
+		n = min(n, max(math.ceil(remaining / self.connections), min_segment), remaining)	# Guided tail
+		start, self.next = self.next, self.next + n
+		self.sizes.append(n)
+		return start, self.next
+
+def content_range(response, start, stop):
+	'Check a 206 answered the range asked for'
+	expected = 'bytes %d-%d/' % (start, stop - 1)
+	if not response.headers.get('content-range', '').startswith(expected) or len(response.body) != stop - start:
+		raise ValueError('%s: asked for bytes %d-%d, got %r' % (response.url, start, stop - 1, response.headers.get('content-range')))
+
+async def bonded(fetcher, url, process, connections=8):
+	'Fetch url in concurrent ranges, calling process(offset, data) per segment. Returns a report'
+	start_time = time.perf_counter()
+	head = await fetcher.fetch(url, 'HEAD')
+	size = int(head.headers.get('content-length', -1))
+	report = {'url': url, 'size': size, 'connections': connections, 'ranged': False}
+	if head.status != 200 or size < 0 or head.headers.get('accept-ranges', '').lower() != 'bytes' or connections < 2:
+		response = await fetcher.fetch(url)
+		if not 200 <= response.status < 300:
+			raise ValueError('%s: answered with %d' % (url, response.status))	# An error page is not the artifact
+		process(0, response.body)	# Single stream: no ranges, no length, or nothing to gain
+		report.update(size=len(response.body), segments=1)
+	else:
+		segments = Segments(size, connections)
+		async def connection():
+			rate = None
+			while True:
+				span = segments.claim(rate)
+				if span is None:
+					return
+				sent = time.perf_counter()
+				response = await fetcher.fetch(url, headers={'Range': 'bytes=%d-%d' % (span[0], span[1] - 1)})
+				if response.status != 206:
+					raise ValueError('%s: range request answered with %d' % (url, response.status))
+				content_range(response, *span)
+				rate = len(response.body) / max(time.perf_counter() - sent, 1e-6)
+				process(span[0], response.body)
+		tasks = [asyncio.ensure_future(connection()) for i in range(connections)]
+		try:
+			await asyncio.gather(*tasks)
+		finally:
+			for task in tasks:
+				task.cancel()
+		report.update(ranged=True, segments=len(segments.sizes), largest_segment=max(segments.sizes, default=0))
+	seconds = time.perf_counter() - start_time
+	report['seconds'] = round(seconds, 3)
+	report['mb_per_sec'] = round(report['size'] / seconds / 1e6, 2)
+	return report
+
+def download(url, process, connections=8, **options):
+	'bonded() from synchronous code. options go to Fetcher'
+	async def main():
+		fetcher = Fetcher(**dict({'limit': connections, 'per_host': connections, 'timeout': 300}, **options))
+		try:
+			return await bonded(fetcher, url, process, connections)
+		finally:
+			fetcher.close()
+	return asyncio.run(main())
+
+def write_at(fd):
+	'A process() that writes each segment into place in an open file'
+	def write(offset, data):
+		os.pwrite(fd, data, offset)
+	return write
+
+def sitesize(url, connections=10):
+	'Count the bytes of each block as received, and add up the results'
+	sizes = []
+	download(url, lambda offset, data: sizes.append(len(data)), connections)
+	return url, sum(sizes)
+
+### Benchmark ###
+
+def benchmark(size, connection_counts, latency, rate):
+	'MB/s against a server with latency per request and rate bytes/s per connection, by connection count'
+	body = stand_in_body(size)
+	report = []
+	for ranges in (True, False):
+		with StandInServer(1, size, latency=latency, handshake=latency, rate=rate, ranges=ranges) as server:
+			for connections in connection_counts if ranges else connection_counts[-1:]:
+				received = bytearray(size)
+				def process(offset, data):
+					received[offset:offset + len(data)] = data
+				result = download(server.bases[0] + '/artifact.bin', process, connections)
+				result['intact'] = received == body
+				del result['url']
+				report.append(result)
+	return report
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+	parser.add_argument('--size', type=float, default=64, help='MB to download')
+	parser.add_argument('--connections', type=int, nargs='+', default=[1, 2, 4, 8])
+	parser.add_argument('--latency', type=float, default=0.05, help='seconds per request and per new connection')
+	parser.add_argument('--rate', type=float, default=2, help='MB/s each connection can carry')
+	args = parser.parse_args()
+	print(json.dumps(benchmark(int(args.size * 1e6), args.connections, args.latency, args.rate * 1e6), indent=2))
@@ -0,0 +1,219 @@
+#!/usr/bin/python3
+
+"""
+Columnar record batches in shared memory, for transforms like the Scientist
+example in multiprocessing_functional.py.
+
+pool.map(transform, scientists) pickles every namedtuple to a worker and a
+fresh dict back. A RecordBatch instead stores each field as one column: a
+string table (UTF-8 blob plus offsets) for text, an int64 array for
+integers and a bitmap for booleans. Every buffer is a SharedArray, so a
+batch pickles as a few names. Workers take contiguous row ranges, read
+their slice of the input columns and write into output columns allocated
+up front by the parent.
+
+Usage: ./record_batch.py [rows] [workers]
+"""
+import array, itertools, json, os, sys, time
+from collections import namedtuple
+from multiprocessing import Pool
+
+from shared_array import SharedArray, evict
+
+class StringColumn:
+	'Strings as one UTF-8 blob plus offsets: row i is data[offsets[i]:offsets[i + 1]]'
+
+	def __init__(self, offsets, data):
+		self.offsets, self.data = offsets, data
+
+	@classmethod
+	def from_values(cls, values):
+		encoded = [value.encode() for value in values]
+		offsets = SharedArray.copy_of('q', itertools.accumulate(map(len, encoded), initial=0))
+		data = SharedArray('B', offsets[len(encoded)])
+		data.view[:] = b''.join(encoded)
+		return cls(offsets, data)
+
+	def __len__(self):
+		return len(self.offsets) - 1
+
+	def __getitem__(self, i):
+		return str(self.data.view[self.offsets[i]:self.offsets[i + 1]], 'utf-8')
+
+	def slice(self, start, stop):
+		offsets, data = self.offsets.view, self.data.view
+		return [str(data[offsets[i]:offsets[i + 1]], 'utf-8') for i in range(start, stop)]
+
+	def buffers(self):
+		return self.offsets, self.data
+
+class IntColumn:
+	'int64 per row'
+
+	def __init__(self, values):
+		self.values = values
+
+	@classmethod
+	def from_values(cls, values):
+		return cls(SharedArray.copy_of('q', values))
+
+	@classmethod
+	def allocate(cls, length):
+		return cls(SharedArray('q', length))
+
+	def __len__(self):
+		return len(self.values)
+
+	def __getitem__(self, i):
+		return self.values[i]
+
+	def slice(self, start, stop):
+		return self.values.view[start:stop].tolist()
+
+	def buffers(self):
+		return self.values,
+
+class BoolColumn:
+	'One bit per row, row i in bit i % 8 of byte i // 8'
+
+	def __init__(self, bits, length):
+		self.bits, self.length = bits, length
+
+	@classmethod
+	def allocate(cls, length):
+		return cls(SharedArray('B', (length + 7) // 8), length)
+
+	@classmethod
+	def from_values(cls, values):
+		values = list(values)
+		column = cls.allocate(len(values))
+		bits = bytearray(len(column.bits))
+		for i in itertools.compress(range(len(values)), values):
+			bits[i >> 3] |= 1 << (i & 7)
+		column.bits.view[:] = bits
+		return column
+
+	def __len__(self):
+		return self.length
+
+	def __getitem__(self, i):
+		return bool(self.bits[i >> 3] >> (i & 7) & 1)
+
+	def slice(self, start, stop):
+		return [self[i] for i in range(start, stop)]
+
+	def buffers(self):
+		return self.bits,
+
+column_types = {'str': StringColumn, 'int': IntColumn, 'bool': BoolColumn}
+
+class RecordBatch:
+	'Named columns of equal length in shared memory. Pickles as shared memory names'
+
+	def __init__(self, columns):
+		self.columns = columns
+		self.length = len(next(iter(columns.values()))) if columns else 0
+
+	@classmethod
+	def from_records(cls, records, kinds):
+		'Columns for the attributes in kinds ({ attribute : "str" | "int" | "bool" }) of a sequence of records'
+		return cls({name: column_types[kind].from_values([getattr(r, name) for r in records]) for name, kind in kinds.items()})
+
+	def __len__(self):
+		return self.length
+
+	def __getitem__(self, name):
+		return self.columns[name]
+
+	def rows(self, start=0, stop=None):
+		'Rows as dicts, for handing results to code that expects records'
+		stop = self.length if stop is None else stop
+		names = list(self.columns)
+		return [dict(zip(names, row)) for row in zip(*(self.columns[name].slice(start, stop) for name in names))]
+
+	def close(self):
+		'Unmap and free every buffer. Columns shared with another batch are freed for it too'
+		for column in self.columns.values():
+			for buf in column.buffers():
+				buf.close()
+				buf.unlink()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+def range_task(args):
+	fn, batch, out, start, stop = args
+	fn(batch, out, start, stop)
+	evict()	# Only now: a wide batch may use more buffers than the attach cache keeps
+
+def map_ranges(pool, fn, batch, out, workers=None, chunks_per_worker=4, align=64):
+	'''Run fn(batch, out, start, stop) over row ranges on the pool. Ranges start on multiples of align rows,
+	so workers filling bitmaps never share a byte'''
+	step = -(-len(batch) // ((workers or os.cpu_count()) * chunks_per_worker)) or 1
+	step = -(-step // align) * align
+	for _ in pool.imap_unordered(range_task, [(fn, batch, out, start, min(start + step, len(batch)))
+			for start in range(0, len(batch), step)]):
+		pass
+	return out
+
+### Scientist transform ###
+
+Scientist = namedtuple('Scientist', ['name', 'field', 'born', 'nobel'])
+scientist_kinds = {'name': 'str', 'field': 'str', 'born': 'int', 'nobel': 'bool'}
+
+def transform(x):
+	'Row at a time, as in multiprocessing_functional.py without the sleep and prints'
+	return {'name': x.name, 'age': 2017 - x.born}
+
+def transform_range(batch, out, start, stop):
+	'Column at a time: age for rows start..stop, written into the preallocated age column'
+	out['age'].values.view[start:stop] = array.array('q', [2017 - born for born in batch['born'].values.view[start:stop]])
+
+def transform_batch(pool, batch, workers=None):
+	'Output batch sharing the name column with the input and a new age column'
+	out = RecordBatch({'name': batch['name'], 'age': IntColumn.allocate(len(batch))})
+	return map_ranges(pool, transform_range, batch, out, workers)
+
+def scientists(rows):
+	base = [
+		Scientist(name='Ada Lovelace', field='math', born=1815, nobel=False),
+		Scientist(name='Emmy Noether', field='math', born=1882, nobel=False),
+		Scientist(name='Marie Curie', field='physics', born=1867, nobel=True),
+		Scientist(name='Tu Youyou', field='chemistry', born=1930, nobel=True),
+		Scientist(name='Ada Yonath', field='chemistry', born=1939, nobel=True),
+		Scientist(name='Vera Rubin', field='astronomy', born=1928, nobel=False),
+		Scientist(name='Sally Ride', field='physics', born=1951, nobel=False),
+	]
+	return [s._replace(name='%s %d' % (s.name, i)) for i, s in zip(range(rows), itertools.cycle(base))]
+
+if __name__ == '__main__':
+	rows = int(float(sys.argv[1])) if len(sys.argv) > 1 else 10**6
+	workers = int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count()
+	records = scientists(rows)
+	report = {'rows': rows, 'workers': workers}
+	with Pool(workers) as pool:
+		start = time.perf_counter()
+		expected = pool.map(transform, records)
+		report['pool_map_seconds'] = round(time.perf_counter() - start, 3)
+		start = time.perf_counter()
+		batch = RecordBatch.from_records(records, scientist_kinds)
+		report['build_batch_seconds'] = round(time.perf_counter() - start, 3)
+		start = time.perf_counter()
+		out = transform_batch(pool, batch, workers)
+		report['batch_transform_seconds'] = round(time.perf_counter() - start, 3)
+		report['same_results'] = out.rows() == expected
+		out['age'].values.close()
+		out['age'].values.unlink()
+		batch.close()
+		# Wider than the worker's attach cache: 5 string columns and an int column are 11 buffers
+		wide = RecordBatch(dict({'text%d' % i: StringColumn.from_values([r.field for r in records]) for i in range(4)},
+			name=StringColumn.from_values([r.name for r in records]), born=IntColumn.from_values([r.born for r in records])))
+		out = transform_batch(pool, wide, workers)
+		report['wide_batch_same_results'] = out.rows() == expected
+		out['age'].values.close()
+		out['age'].values.unlink()
+		wide.close()
+	print(json.dumps(report))
@@ -0,0 +1,58 @@
+#!/usr/bin/python3
+
+"""
+Resident memory per idle session for each backend in async_example.py.
+
+Starts the server in a child process, opens N idle client connections,
+waits for each welcome banner so the server has built the session,
+and reports how much the server's RSS grew per session.
+
+Usage: ./session_memory.py [sessions] [reactor|asyncio]
+"""
+import json, resource, socket, sys
+from multiprocessing import Process
+
+from backend_benchmark import serve, wait_for_port
+
+ports_per_source = 20000	# Stay inside the ephemeral port range of each loopback source address
+
+def rss(pid):
+	'Resident set size of a process in bytes'
+	with open('/proc/%d/status' % pid) as status:
+		for line in status:
+			if line.startswith('VmRSS:'):
+				return int(line.split()[1]) * 1024
+
+def measure(sessions, backend='reactor', port=9800):
+	soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+	resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))	# The server process inherits this too
+	sessions = min(sessions, hard - 64)
+	server = Process(target=serve, args=(backend, port))
+	server.start()
+	clients = []
+	try:
+		wait_for_port(port)
+		before = rss(server.pid)
+		for i in range(sessions):
+			source = '127.0.0.%d' % (2 + i // ports_per_source)
+			c = socket.create_connection(('localhost', port), source_address=(source, 0))
+			c.recv(64)	# Welcome banner
+			clients.append(c)
+		after = rss(server.pid)
+	finally:
+		for c in clients:
+			c.close()
+		server.terminate()
+		server.join()
+	return {
+		'backend': backend,
+		'sessions': sessions,
+		'rss_before': before,
+		'rss_after': after,
+		'bytes_per_session': round((after - before) / sessions),
+	}
+
+if __name__ == '__main__':
+	sessions = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+	backend = sys.argv[2] if len(sys.argv) > 2 else 'reactor'
+	print(json.dumps(measure(sessions, backend)))
@@ -0,0 +1,174 @@
+#!/usr/bin/python3
+
+"""
+A counter shared by many processes that add to it without a lock.
+
+The Value + Lock counter in multiprocessing_python.py makes every process
+queue on one lock, and the cache line holding the value bounces between
+cores on every increment. A ShardedCounter gives each process a slot of its
+own in a shared Array. Every slot sits on a separate cache line, so an add
+only touches memory no other process writes. Reads sum the slots.
+
+A process gives its slot back when it exits normally (or calls release()),
+folding its count into a retired total, so pools that replace workers
+don't run out. A process killed outright keeps its slot. If every slot is
+taken, add() falls back to one shared slot behind the lock: slower, never
+an error.
+
+Usage: ./sharded_counter.py [total increments] [process counts...]
+"""
+import ctypes, json, os, sys, time, weakref
+from multiprocessing import Array, Lock, Pool, Process, Value, util
+
+cache_line = 64	# Bytes; slots closer than this share a line and invalidate each other
+counters = weakref.WeakSet()	# Every ShardedCounter in this process, so forked children claim new slots
+releasing = None	# Pid that has registered release_slots() to run at its exit
+
+class ShardedCounter:
+	'One 64-bit slot per process, each on its own cache line. Create before forking the processes'
+
+	def __init__(self, shards=64):
+		self.shards = shards
+		self.stride = cache_line // ctypes.sizeof(ctypes.c_int64)
+		# The shards, then the overflow slot, plus one spare line so the first slot can start on a line boundary
+		self.slots = Array(ctypes.c_int64, (shards + 2) * self.stride, lock=False)
+		self.baseline = Array(ctypes.c_int64, (shards + 2) * self.stride, lock=False)	# Slot values at the last reset
+		self.first = -ctypes.addressof(self.slots) % cache_line // ctypes.sizeof(ctypes.c_int64)
+		self.overflow = self.first + shards * self.stride	# Shared by processes that found no free slot; locked
+		self.claimed = Value(ctypes.c_int, 0)	# Slots handed out so far; its lock guards everything below and reset
+		self.free = Array(ctypes.c_int, shards, lock=False)	# Stack of released shard numbers
+		self.free_count = Value(ctypes.c_int, 0, lock=False)
+		self.retired = Value(ctypes.c_int64, 0, lock=False)	# Counts of released slots since the last reset
+		self.index = None	# This process's slot, claimed on first add
+		counters.add(self)
+
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		state['index'] = None	# A spawned child claims its own slot
+		return state
+
+	def claim(self):
+		global releasing
+		with self.claimed.get_lock():
+			if self.free_count.value:
+				self.free_count.value -= 1
+				shard = self.free[self.free_count.value]
+			elif self.claimed.value < self.shards:
+				shard = self.claimed.value
+				self.claimed.value += 1
+			else:
+				shard = self.shards	# The overflow slot
+		self.index = self.first + shard * self.stride
+		if releasing != os.getpid():
+			releasing = os.getpid()
+			util.Finalize(None, release_slots, exitpriority=0)	# Runs as a multiprocessing child exits normally
+		return self.index
+
+	def release(self):
+		'Give this process\'s slot back, its count kept in the retired total. The next add() claims one again'
+		i, self.index = self.index, None
+		if i is None or i == self.overflow:
+			return
+		with self.claimed.get_lock():
+			self.retired.value += self.slots[i] - self.baseline[i]
+			self.baseline[i] = self.slots[i]
+			self.free[self.free_count.value] = (i - self.first) // self.stride
+			self.free_count.value += 1
+
+	def add(self, n=1):
+		'Add n to this process\'s slot. No lock: nobody else writes it'
+		i = self.index
+		if i is None:
+			i = self.claim()
+		if i == self.overflow:
+			with self.claimed.get_lock():
+				self.slots[i] += n
+		else:
+			self.slots[i] += n
+
+	def values(self):
+		'Count per claimed slot since the last reset'
+		return [self.slots[i] - self.baseline[i] for i in range(self.first, self.first + self.claimed.value * self.stride, self.stride)]
+
+	def snapshot(self):
+		'Total since the last reset. Adds racing with the read may or may not be included'
+		with self.claimed.get_lock():
+			overflow = self.slots[self.overflow] - self.baseline[self.overflow]
+			return sum(self.values()) + self.retired.value + overflow
+
+	def reset(self):
+		'Start counting from zero again. Slots are never written by the reader: the baseline remembers them instead'
+		with self.claimed.get_lock():
+			for i in list(range(self.first, self.first + self.claimed.value * self.stride, self.stride)) + [self.overflow]:
+				self.baseline[i] = self.slots[i]
+			self.retired.value = 0
+
+def release_slots():
+	for counter in list(counters):
+		counter.release()
+
+def forget_slots():
+	for counter in counters:
+		counter.index = None
+
+os.register_at_fork(after_in_child=forget_slots)
+
+### Benchmark ###
+
+def locked_worker(value, lock, n):
+	for i in range(n):
+		with lock:
+			value.value += 1
+
+def sharded_worker(counter, n):
+	for i in range(n):
+		counter.add()
+
+def use_counter(counter):
+	global shared_counter
+	shared_counter = counter
+
+def churn_task(n):
+	for i in range(n):
+		shared_counter.add()
+
+def churn(shards=4, tasks=50, n=1000):
+	'A Pool replacing its worker after every task: far more processes than shards over the run'
+	counter = ShardedCounter(shards)
+	with Pool(2, use_counter, (counter,), maxtasksperchild=1) as pool:
+		pool.map(churn_task, [n] * tasks, chunksize=1)
+	return counter.snapshot() == tasks * n
+
+def run(target, args, processes, n):
+	'Seconds for processes workers to do n increments each'
+	workers = [Process(target=target, args=args + (n,)) for i in range(processes)]
+	start = time.perf_counter()
+	for p in workers:
+		p.start()
+	for p in workers:
+		p.join()
+	return time.perf_counter() - start
+
+def benchmark(total=10**6, process_counts=(2, 4, 8, 16, 32, 64)):
+	'Increments per second for Value+Lock and ShardedCounter as the process count grows'
+	report = {}
+	for processes in process_counts:
+		n = total // processes
+		value, lock = Value('q', 0, lock=False), Lock()
+		locked = run(locked_worker, (value, lock), processes, n)
+		counter = ShardedCounter(processes)
+		sharded = run(sharded_worker, (counter,), processes, n)
+		report[processes] = {
+			'value_lock': round(n * processes / locked),
+			'sharded': round(n * processes / sharded),
+			'correct': value.value == counter.snapshot() == n * processes,
+		}
+	return report
+
+if __name__ == '__main__':
+	total = int(float(sys.argv[1])) if len(sys.argv) > 1 else 10**6
+	process_counts = list(map(int, sys.argv[2:])) or [2, 4, 8, 16, 32, 64]
+	report = benchmark(total, process_counts)
+	for processes, rates in report.items():
+		print('%3d processes  Value+Lock %10d/s   sharded %10d/s' % (processes, rates['value_lock'], rates['sharded']))
+	print(json.dumps({'total': total, 'results': report, 'worker_churn_correct': churn()}))
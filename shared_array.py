@@ -0,0 +1,160 @@
+#!/usr/bin/python3
+
+"""
+Typed arrays in multiprocessing.shared_memory, and a Pool map that writes
+its results straight into one.
+
+pool.map() pickles every result in the worker and unpickles it again in the
+parent, which for a million small numbers costs more than the work. A
+SharedArray pickles as just its name, so a worker that is handed one
+attaches to the same memory. shared_map() gives each worker a range of
+indexes: it reads its inputs from one SharedArray and writes the results
+into another, and the parent gets that array back without copying.
+
+Usage: ./shared_array.py [items] [workers]
+"""
+import array, json, os, sys, time
+from multiprocessing import Pool, resource_tracker, shared_memory
+
+attached = {}	# { shared memory name : SharedArray } attached in this process
+max_attached = 8	# Unmap the least recently used beyond this many after each task, so long-lived workers don't pin freed memory
+
+def open_shared_memory(name):
+	'Attach to a block another process created. Only the creator registers it with the resource tracker'
+	if sys.version_info >= (3, 13):
+		return shared_memory.SharedMemory(name, track=False)
+	# Earlier versions register on attach too, so a worker's tracker would unlink the block when the worker exits
+	register = resource_tracker.register
+	resource_tracker.register = lambda name, rtype: None
+	try:
+		return shared_memory.SharedMemory(name)
+	finally:
+		resource_tracker.register = register
+
+class SharedArray:
+	'Fixed-length array of one struct typecode (as in the array module) in a named shared memory block'
+
+	def __init__(self, typecode, length, name=None):
+		itemsize = array.array(typecode).itemsize
+		create = name is None
+		self.shm = shared_memory.SharedMemory(size=max(length * itemsize, 1), create=True) if create else open_shared_memory(name)
+		self.owner = create	# Only the creator unlinks
+		self.typecode = typecode
+		self.length = length
+		self.view = self.shm.buf[:length * itemsize].cast(typecode)
+
+	@classmethod
+	def copy_of(cls, typecode, items):
+		'New shared array holding items, the one copy needed to share an input'
+		items = items if isinstance(items, array.array) and items.typecode == typecode else array.array(typecode, items)
+		shared = cls(typecode, len(items))
+		shared.view[:] = items
+		return shared
+
+	@property
+	def name(self):
+		return self.shm.name
+
+	def __reduce__(self):
+		return attach, (self.name, self.typecode, self.length)
+
+	def __len__(self):
+		return self.length
+
+	def __getitem__(self, i):
+		return self.view[i]
+
+	def __setitem__(self, i, value):
+		self.view[i] = value
+
+	def tolist(self):
+		return self.view.tolist()
+
+	def close(self):
+		'Unmap this process\'s view. Fails with BufferError while slices of view are still held'
+		self.view.release()
+		self.shm.close()
+
+	def unlink(self):
+		'Free the memory once every process has closed it'
+		if self.owner:
+			self.shm.unlink()
+			self.owner = False
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+		self.unlink()
+
+def attach(name, typecode, length):
+	'Unpickled SharedArray: reuse this process\'s mapping of name if it has one'
+	shared = attached.pop(name, None)
+	if shared is None:
+		shared = SharedArray(typecode, length, name)
+	attached[name] = shared	# Most recently used last
+	return shared
+
+def evict():
+	'''Unmap the least recently used attachments beyond max_attached. Call between tasks only: the task that
+	just ran may have used more than max_attached arrays, all of them needed until it returned'''
+	while len(attached) > max_attached:
+		oldest = attached.pop(next(iter(attached)))
+		try:
+			oldest.close()
+		except BufferError:	# Still in use here; it is unmapped when the process exits
+			pass
+
+def fill_range(fn, inputs, outputs, start, stop):
+	'Worker side: outputs[i] = fn(inputs[i]) for one range of indexes'
+	outputs.view[start:stop] = array.array(outputs.typecode, map(fn, inputs.view[start:stop]))
+
+def fill_task(args):
+	fill_range(*args)
+	evict()
+
+def shared_map(pool, fn, inputs, typecode='d', workers=None, chunks_per_worker=4):
+	'''Like pool.map(fn, inputs) for numeric fn, returning a SharedArray of typecode.
+	inputs may be a SharedArray; anything else is copied into one first'''
+	copied = not isinstance(inputs, SharedArray)
+	if copied:
+		inputs = inputs if hasattr(inputs, '__len__') else list(inputs)	# Peeking must not consume an iterator
+		first = next(iter(inputs), 0)
+		inputs = SharedArray.copy_of('q' if isinstance(first, int) else 'd', inputs)
+	outputs = SharedArray(typecode, len(inputs))
+	try:
+		step = -(-len(inputs) // ((workers or os.cpu_count()) * chunks_per_worker)) or 1
+		ranges = [(fn, inputs, outputs, start, min(start + step, len(inputs))) for start in range(0, len(inputs), step)]
+		for _ in pool.imap_unordered(fill_task, ranges):
+			pass
+	except BaseException:
+		outputs.close()
+		outputs.unlink()
+		raise
+	finally:
+		if copied:
+			inputs.close()
+			inputs.unlink()
+	return outputs
+
+### Benchmark ###
+
+def squared(n):
+	return n * n
+
+if __name__ == '__main__':
+	items = int(float(sys.argv[1])) if len(sys.argv) > 1 else 10**6
+	workers = int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count()
+	report = {'items': items, 'workers': workers}
+	with Pool(workers) as pool:
+		start = time.perf_counter()
+		expected = pool.map(squared, range(items))
+		report['pool_map_seconds'] = round(time.perf_counter() - start, 3)
+		with SharedArray.copy_of('q', range(items)) as inputs:
+			start = time.perf_counter()
+			with shared_map(pool, squared, inputs, 'q', workers) as result:
+				report['shared_map_seconds'] = round(time.perf_counter() - start, 3)
+				report['same_results'] = result.view.tolist() == expected
+	report['speedup'] = round(report['pool_map_seconds'] / report['shared_map_seconds'], 2)
+	print(json.dumps(report))
@@ -0,0 +1,265 @@
+#!/usr/bin/python3
+
+"""
+Fixed-capacity hash map in multiprocessing.shared_memory, for lookup tables
+and counters shared by many processes.
+
+A Manager().dict() lives in a server process, so every d[k] += 1 is two
+round trips through a proxy. A SharedDict lives in shared memory that any
+process can attach to by name. It is laid out like the compact dict in
+modern_dictionaries.py (compact_and_ordered): a sparse index of entry
+positions, probed with the same perturb sequence, over dense arrays of
+hashes, fixed-width keys and fixed-width numeric values kept in insertion
+order.
+
+Lookups take no lock. A new entry is written completely before its index
+slot is published, and values are single aligned 8-byte stores. Updates to
+existing values lock one stripe of the entries. Inserts take the insert
+lock, so two processes can't add the same key twice. The locks are fcntl
+byte-range locks on the shared memory file itself, so a process that
+attached by name can write too. That needs a /dev/shm filesystem (Linux).
+Keys can't be deleted.
+
+Usage: ./shm_dict.py [operations] [processes]
+"""
+import array, fcntl, json, os, sys, threading, time, zlib
+from multiprocessing import Manager, Process, shared_memory
+
+from shared_array import open_shared_memory
+
+header = array.array('q', [0] * 8)	# capacity, index size, key size, value typecode, count
+stripes = 64	# Value update locks; entry pos is guarded by stripe pos % stripes
+EMPTY = -1
+
+def align(offset, size=8):
+	return -(-offset // size) * size
+
+class SharedDict:
+	'Map of str or bytes keys up to key_size bytes to int (typecode q) or float (d) values'
+
+	def __init__(self, capacity=1024, key_size=16, typecode='q', name=None):
+		create = name is None
+		if create:
+			index_size = 8
+			while index_size < capacity * 3 // 2:	# Keep the index at most two thirds full
+				index_size *= 2
+			layout = self.layout(capacity, index_size, key_size, typecode)
+			self.shm = shared_memory.SharedMemory(create=True, size=layout[-1])
+		else:
+			self.shm = open_shared_memory(name)
+		meta = self.shm.buf[:len(header) * header.itemsize].cast('q')
+		if create:
+			meta[:5] = array.array('q', [capacity, index_size, key_size, ord(typecode), 0])
+		self.meta = meta
+		self.capacity, index_size, self.key_size, typecode = meta[0], meta[1], meta[2], chr(meta[3])
+		index_at, hashes_at, keys_at, values_at, end = self.layout(self.capacity, index_size, self.key_size, typecode)
+		buf = self.shm.buf
+		self.index = buf[index_at:hashes_at].cast('i')	# Entry position per slot, or EMPTY
+		self.hashes = buf[hashes_at:keys_at].cast('I')
+		self.keys_ = buf[keys_at:values_at]	# Keys padded with NUL bytes, key_size apart
+		self.values = buf[values_at:end].cast(typecode)
+		if create:
+			self.index[:] = array.array('i', [EMPTY]) * index_size
+		self.mask = index_size - 1
+		self.owner = create
+		self.lock_file = os.open('/dev/shm/' + self.shm.name.lstrip('/'), os.O_RDWR)
+		self.local = threading.Lock()	# fcntl locks belong to the process, so threads queue here first
+
+	@staticmethod
+	def layout(capacity, index_size, key_size, typecode):
+		'Byte offsets of the index, hashes, keys and values, and the total size'
+		index_at = len(header) * header.itemsize
+		hashes_at = index_at + index_size * 4
+		keys_at = hashes_at + capacity * 4
+		values_at = align(keys_at + capacity * key_size)
+		return index_at, hashes_at, keys_at, values_at, values_at + capacity * array.array(typecode).itemsize
+
+	@property
+	def name(self):
+		return self.shm.name
+
+	def __reduce__(self):
+		return attach, (self.name,)
+
+	def encode(self, key):
+		key = key.encode() if isinstance(key, str) else bytes(key)
+		if len(key) > self.key_size:
+			raise ValueError('key %r is longer than %d bytes' % (key, self.key_size))
+		return key.ljust(self.key_size, b'\0')
+
+	def find(self, key):
+		'(entry position or EMPTY, index slot where the probe ended, hash) for an encoded key'
+		h = perturb = zlib.crc32(key)	# Same in every process, unlike hash() of a str
+		i = h & self.mask
+		index, hashes, keys, size = self.index, self.hashes, self.keys_, self.key_size
+		while True:
+			pos = index[i]
+			if pos == EMPTY:
+				return EMPTY, i, h
+			if hashes[pos] == h and keys[pos * size:(pos + 1) * size] == key:
+				return pos, i, h
+			i = (5 * i + perturb + 1) & self.mask
+			perturb >>= 5
+
+	def lock(self, n):
+		'Exclusive lock n: 0 is the insert lock, 1.. the stripes'
+		return ByteLock(self, n)
+
+	def insert(self, key, value):
+		'Add an entry for a key found missing, unless another process got there first. Returns its position'
+		with self.lock(0):
+			pos, i, h = self.find(key)	# Again, now that nobody else can insert
+			if pos != EMPTY:
+				return pos
+			pos = self.meta[4]
+			if pos >= self.capacity:
+				raise ValueError('SharedDict is full (%d entries)' % self.capacity)
+			self.hashes[pos] = h
+			self.keys_[pos * self.key_size:(pos + 1) * self.key_size] = key
+			self.values[pos] = value
+			self.index[i] = pos	# Publish last: readers now see a complete entry
+			self.meta[4] = pos + 1
+			return EMPTY
+
+	def get(self, key, default=None):
+		pos = self.find(self.encode(key))[0]
+		return default if pos == EMPTY else self.values[pos]
+
+	def __getitem__(self, key):
+		pos = self.find(self.encode(key))[0]
+		if pos == EMPTY:
+			raise KeyError(key)
+		return self.values[pos]
+
+	def __setitem__(self, key, value):
+		key = self.encode(key)
+		pos = self.find(key)[0]
+		if pos == EMPTY:
+			pos = self.insert(key, value)
+			if pos == EMPTY:
+				return
+		with self.lock(1 + pos % stripes):	# Same stripe as increment(), so neither loses the other's update
+			self.values[pos] = value
+
+	def increment(self, key, n=1):
+		'Add n to the value for key, starting from 0. Returns the new value'
+		key = self.encode(key)
+		pos = self.find(key)[0]
+		if pos == EMPTY:
+			pos = self.insert(key, n)
+			if pos == EMPTY:
+				return n
+		with self.lock(1 + pos % stripes):
+			value = self.values[pos] = self.values[pos] + n
+		return value
+
+	def __contains__(self, key):
+		return self.find(self.encode(key))[0] != EMPTY
+
+	def __len__(self):
+		return self.meta[4]
+
+	def keys(self):
+		'Keys in insertion order, as bytes'
+		size = self.key_size
+		return [bytes(self.keys_[pos * size:(pos + 1) * size]).rstrip(b'\0') for pos in range(len(self))]
+
+	def items(self):
+		return list(zip(self.keys(), self.values[:len(self)].tolist()))
+
+	def close(self):
+		os.close(self.lock_file)
+		for view in (self.meta, self.index, self.hashes, self.keys_, self.values):
+			view.release()
+		self.shm.close()
+
+	def unlink(self):
+		if self.owner:
+			self.shm.unlink()
+			self.owner = False
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+		self.unlink()
+
+class ByteLock:
+	'Lock byte n of the shared memory file, shared by every process that opened it'
+	__slots__ = ('d', 'n')
+
+	def __init__(self, d, n):
+		self.d, self.n = d, n
+
+	def __enter__(self):
+		self.d.local.acquire()
+		fcntl.lockf(self.d.lock_file, fcntl.LOCK_EX, 1, self.n)
+
+	def __exit__(self, *exc):
+		fcntl.lockf(self.d.lock_file, fcntl.LOCK_UN, 1, self.n)
+		self.d.local.release()
+
+def attach(name):
+	'Open a SharedDict another process created'
+	return SharedDict(name=name)
+
+### Benchmark ###
+
+def rate(fn, keys, operations):
+	'Operations per second for fn(key) cycling through keys'
+	start = time.perf_counter()
+	for i in range(operations):
+		fn(keys[i % len(keys)])
+	return round(operations / (time.perf_counter() - start))
+
+def increment_worker(name, keys, operations):
+	d = attach(name)
+	for i in range(operations):
+		d.increment(keys[i % len(keys)])
+	d.close()
+
+def manager_increment_worker(d, lock, keys, operations):
+	for i in range(operations):
+		with lock:	# += on a proxy is a get and a set, so it needs a lock to be exact
+			d[keys[i % len(keys)]] += 1
+
+def run_workers(target, args, processes):
+	workers = [Process(target=target, args=args) for i in range(processes)]
+	start = time.perf_counter()
+	for p in workers:
+		p.start()
+	for p in workers:
+		p.join()
+	return time.perf_counter() - start
+
+def benchmark(operations=10**5, processes=4):
+	keys = ['key%d' % i for i in range(1000)]
+	report = {}
+	with SharedDict(len(keys)) as shared, Manager() as manager:
+		proxy, lock = manager.dict(), manager.Lock()
+		for name, d in (('shared', shared), ('manager', proxy)):
+			n = operations if d is shared else operations // 10	# The proxy is too slow for the full count
+			results = report[name] = {}
+			results['set'] = rate(lambda key: d.__setitem__(key, 0), keys, n)
+			results['get'] = rate(d.__getitem__, keys, n)
+			if d is shared:
+				results['increment'] = rate(d.increment, keys, n)
+				for key in keys:
+					d[key] = 0
+				seconds = run_workers(increment_worker, (d.name, keys, n), processes)
+			else:
+				results['increment'] = rate(lambda key: d.__setitem__(key, d[key] + 1), keys, n)
+				d.update(dict.fromkeys(keys, 0))
+				seconds = run_workers(manager_increment_worker, (d, lock, keys, n), processes)
+			results['increment_%d_processes' % processes] = round(n * processes / seconds)
+			results['exact'] = sum(d[key] for key in keys) == n * processes
+	return report
+
+if __name__ == '__main__':
+	operations = int(float(sys.argv[1])) if len(sys.argv) > 1 else 10**5
+	processes = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+	report = benchmark(operations, processes)
+	for name, results in report.items():
+		print('%-8s' % name + '  '.join('%s %d/s' % (op, r) for op, r in results.items() if op != 'exact'))
+	print(json.dumps({'operations': operations, 'processes': processes, 'results': report}))
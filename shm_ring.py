@@ -0,0 +1,279 @@
+#!/usr/bin/python3
+
+"""
+Pipe-style channels over single-producer, single-consumer byte rings in
+multiprocessing.shared_memory.
+
+One process writes a ring and one reads it. The writer only ever stores the
+head count and the reader only the tail count, so neither needs a lock.
+Each count sits on its own cache line. A side that has to wait spins for a
+while, then raises its waiting flag and sleeps on a semaphore. The other
+side posts the semaphore only when it sees the flag, so a busy stream makes
+no system calls at all.
+
+RingPipe() returns two RingConnections with the send/recv/send_bytes/
+recv_bytes/recv_bytes_into/poll API of multiprocessing.Pipe(). bytes go
+through as they are; only other objects are pickled.
+
+The counts are published with plain stores after the data is copied. That
+relies on the processor keeping stores in order, as x86 does. The flag
+handshake can miss a wakeup when a store and a load cross, so every sleep
+is bounded by block_timeout.
+
+Usage: ./shm_ring.py [round trips]
+"""
+import os, pickle, struct, sys, time
+from multiprocessing import BufferTooShort, Pipe, Process, Semaphore, shared_memory
+
+from shared_array import open_shared_memory
+
+# Indexes into the header of uint64s; the four fields written by different sides are 64 bytes apart
+HEAD, CAPACITY, CLOSED, TAIL, READER_WAITING, WRITER_WAITING = 0, 1, 2, 8, 16, 24
+header_size = 256
+spin = 0 if os.cpu_count() == 1 else 2000	# Polls before sleeping; on one CPU the other side can't run while we spin
+block_timeout = 0.01	# Longest sleep, in case a wakeup was missed
+frame = struct.Struct('Q')	# Message size << 1 | 1 if the payload is a pickle
+small_message = 1024	# Sent together with their frame in a single write
+
+class Ring:
+	'One-way byte stream between two processes. Create before starting the other process'
+
+	def __init__(self, capacity=1 << 20, name=None, data_ready=None, space_ready=None):
+		create = name is None
+		if create:
+			if capacity & (capacity - 1):
+				raise ValueError('capacity must be a power of two')
+			self.shm = shared_memory.SharedMemory(create=True, size=header_size + capacity)
+		else:
+			self.shm = open_shared_memory(name)	# Without the semaphores, sleeps just time out
+		self.counters = self.shm.buf[:header_size].cast('Q')
+		if create:
+			self.counters[CAPACITY] = capacity
+		self.capacity = self.counters[CAPACITY]
+		self.mask = self.capacity - 1
+		self.data = self.shm.buf[header_size:header_size + self.capacity]
+		self.data_ready = data_ready or Semaphore(0)	# Posted by the writer for a sleeping reader
+		self.space_ready = space_ready or Semaphore(0)	# Posted by the reader for a sleeping writer
+		self.owner = os.getpid() if create else None	# Forked children must not unlink it
+		self.writer = None	# Pid that last wrote here: only it may signal EOF
+		self.refs = 0	# RingConnections in this process using the ring
+		self.closed = False
+
+	def __reduce__(self):
+		return Ring, (None, self.shm.name, self.data_ready, self.space_ready)
+
+	def wait(self, ready, flag, semaphore, timeout=None):
+		'Until ready() or timeout: spin, then sleep on semaphore with flag raised. Returns ready()'
+		for i in range(spin):
+			if ready():
+				return True
+		counters = self.counters
+		deadline = None if timeout is None else time.monotonic() + timeout
+		while not ready():
+			remaining = block_timeout if deadline is None else min(deadline - time.monotonic(), block_timeout)
+			if remaining <= 0:
+				break
+			counters[flag] = 1
+			if not ready():	# Re-check with the flag up, or a wakeup sent just before could be lost
+				semaphore.acquire(timeout=remaining)
+		counters[flag] = 0
+		return ready()
+
+	def wake(self, flag, semaphore):
+		if self.counters[flag]:
+			self.counters[flag] = 0
+			semaphore.release()
+
+	def write(self, data):
+		data = memoryview(data).cast('B')
+		counters, capacity, mask = self.counters, self.capacity, self.mask
+		self.writer = os.getpid()
+		head = counters[HEAD]
+		done = 0
+		while done < len(data):
+			free = capacity - (head - counters[TAIL])
+			if not free:
+				self.wait(lambda: counters[TAIL] + capacity > head, WRITER_WAITING, self.space_ready)
+				continue
+			i = head & mask
+			n = min(free, len(data) - done, capacity - i)	# Up to the end of the buffer, then wrap
+			self.data[i:i + n] = data[done:done + n]
+			done += n
+			head += n
+			counters[HEAD] = head	# Publish after the copy
+			self.wake(READER_WAITING, self.data_ready)
+
+	def read_into(self, buf, size):
+		'Fill the first size bytes of buf. EOFError if the writer closed first'
+		buf = memoryview(buf).cast('B')
+		counters, capacity, mask = self.counters, self.capacity, self.mask
+		tail = counters[TAIL]
+		done = 0
+		while done < size:
+			available = counters[HEAD] - tail
+			if not available:
+				if counters[CLOSED]:
+					raise EOFError
+				self.wait(lambda: counters[HEAD] != tail or counters[CLOSED], READER_WAITING, self.data_ready)
+				continue
+			i = tail & mask
+			n = min(available, size - done, capacity - i)
+			buf[done:done + n] = self.data[i:i + n]
+			done += n
+			tail += n
+			counters[TAIL] = tail	# Hand the space back to the writer
+			self.wake(WRITER_WAITING, self.space_ready)
+
+	def readable(self, timeout=0.0):
+		counters, tail = self.counters, self.counters[TAIL]
+		ready = lambda: counters[HEAD] != tail or counters[CLOSED]
+		return bool(ready() or timeout and self.wait(ready, READER_WAITING, self.data_ready, timeout))
+
+	def shutdown(self):
+		'Writer side: no more data. The reader gets EOFError once it has read what is left'
+		if self.closed:
+			return
+		self.counters[CLOSED] = 1
+		self.data_ready.release()
+
+	def close(self):
+		'Drop one RingConnection\'s use of the ring. Unmapped when the last in this process lets go'
+		self.refs -= 1
+		if self.closed or self.refs > 0:
+			return
+		self.closed = True
+		for view in (self.counters, self.data):
+			view.release()
+		self.shm.close()
+		if self.owner == os.getpid():
+			self.shm.unlink()
+
+class RingConnection:
+	'One end of a RingPipe: receives from inbox, sends on outbox, like multiprocessing.connection.Connection'
+
+	def __init__(self, inbox, outbox):
+		self.inbox, self.outbox = inbox, outbox
+		self.closed = False
+		self.hold()
+
+	def hold(self):
+		for ring in (self.inbox, self.outbox):
+			if ring:
+				ring.refs += 1
+
+	def __setstate__(self, state):
+		'Unpickled in a spawned child: its rings are fresh mappings that this end now holds'
+		self.__dict__.update(state)
+		self.hold()
+
+	def send_bytes(self, buf, offset=0, size=None):
+		view = memoryview(buf).cast('B')
+		view = view[offset:] if size is None else view[offset:offset + size]
+		self.write(view, 0)
+
+	def send(self, obj):
+		'bytes-like objects travel as they are, everything else is pickled'
+		if isinstance(obj, (bytes, bytearray, memoryview)):
+			self.write(memoryview(obj).cast('B'), 0)
+		else:
+			self.write(pickle.dumps(obj, pickle.HIGHEST_PROTOCOL), 1)
+
+	def write(self, payload, pickled):
+		header = frame.pack(len(payload) << 1 | pickled)
+		if len(payload) < small_message:
+			self.outbox.write(header + bytes(payload))	# One publish, one wakeup check
+		else:
+			self.outbox.write(header)
+			self.outbox.write(payload)
+
+	def header(self):
+		'(size, pickled) of the next message'
+		buf = bytearray(frame.size)
+		self.inbox.read_into(buf, frame.size)
+		value = frame.unpack(buf)[0]
+		return value >> 1, value & 1
+
+	def read(self, size):
+		buf = bytearray(size)
+		self.inbox.read_into(buf, size)
+		return buf
+
+	def recv_bytes(self, maxlength=None):
+		size, pickled = self.header()
+		if maxlength is not None and size > maxlength:
+			self.read(size)
+			raise OSError('bad message length')
+		return bytes(self.read(size))
+
+	def recv_bytes_into(self, buf, offset=0):
+		'Read the next message into buf at offset, returning its size. BufferTooShort carries it if it won\'t fit'
+		view = memoryview(buf).cast('B')
+		if not 0 <= offset <= len(view):
+			raise ValueError('offset out of bounds')
+		size, pickled = self.header()
+		if size > len(view) - offset:
+			raise BufferTooShort(bytes(self.read(size)))
+		self.inbox.read_into(view[offset:], size)
+		return size
+
+	def recv(self):
+		size, pickled = self.header()
+		data = self.read(size)
+		return pickle.loads(data) if pickled else bytes(data)
+
+	def poll(self, timeout=0.0):
+		'Whether a message (or EOF) is waiting, after waiting up to timeout seconds; None waits forever'
+		return self.inbox.readable(sys.maxsize if timeout is None else timeout)
+
+	def close(self):
+		'''Unmap this end in this process only. EOF reaches the reader if this process wrote to the outbox, so a
+		parent closing its copy of the child's end after start() leaves the child's rings alone, as with Pipe()'''
+		if self.closed:
+			return
+		self.closed = True
+		if self.outbox and self.outbox.writer == os.getpid():
+			self.outbox.shutdown()
+		for ring in (self.inbox, self.outbox):
+			if ring:
+				ring.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+def RingPipe(duplex=True, capacity=1 << 20):
+	'Like multiprocessing.Pipe(): two connected ends. With duplex False the first end can only receive'
+	a = Ring(capacity)
+	if not duplex:
+		return RingConnection(a, None), RingConnection(None, a)
+	b = Ring(capacity)
+	return RingConnection(a, b), RingConnection(b, a)
+
+### Benchmark ###
+
+def ponger(p, s, count):
+	'The ponger(p, s) example from multiprocessing_python.py, without the sleep'
+	for i in range(count):
+		p.recv()
+		p.send(s)
+
+def round_trips(make, count):
+	parent, child = make()
+	proc = Process(target=ponger, args=(child, 'ping', count))
+	proc.start()
+	start = time.perf_counter()
+	for i in range(count):
+		parent.send('pong')
+		parent.recv()
+	seconds = time.perf_counter() - start
+	proc.join()
+	parent.close()
+	child.close()
+	return round(count / seconds)
+
+if __name__ == '__main__':
+	count = int(float(sys.argv[1])) if len(sys.argv) > 1 else 10000
+	for name, make in (('Pipe', Pipe), ('RingPipe', RingPipe)):
+		print('%-8s %8d round trips/s' % (name, round_trips(make, count)))
@@ -0,0 +1,140 @@
+#!/usr/bin/python3
+
+"""
+Streaming parallel map from a CSV or JSON-lines file to a sink, in memory
+bounded by the window rather than by the file.
+
+multiprocessing_functional.py holds every record in a tuple and every
+result in the list pool.map() returns. Pool.imap() doesn't help on its own:
+its task thread reads the whole input as fast as it can, so a multi-GB file
+still ends up in memory. stream_map() reads records lazily, sends them to
+the pool in chunks with apply_async, and never has more than window chunks
+submitted and not yet written out. Results go to the sink as they come, in
+input order or, unordered, as soon as each chunk is done.
+
+Usage: ./streaming.py [rows] [workers]
+"""
+import collections, csv, json, itertools, os, queue, resource, sys, tempfile, time
+from multiprocessing import Pool, Process, Queue
+
+def read_csv(path):
+	'One dict per row, keyed by the header line'
+	with open(path, newline='') as f:
+		yield from csv.DictReader(f)
+
+def read_jsonl(path):
+	with open(path) as f:
+		for line in f:
+			if line.strip():
+				yield json.loads(line)
+
+def read_records(path):
+	return read_csv(path) if path.endswith('.csv') else read_jsonl(path)
+
+def write_jsonl(path, results):
+	'Write each result as it arrives. Returns the number written'
+	count = 0
+	with open(path, 'w') as f:
+		for result in results:
+			f.write(json.dumps(result) + '\n')
+			count += 1
+	return count
+
+def write_csv(path, results):
+	count = 0
+	with open(path, 'w', newline='') as f:
+		writer = None
+		for result in results:
+			if writer is None:	# Columns come from the first result
+				writer = csv.DictWriter(f, list(result))
+				writer.writeheader()
+			writer.writerow(result)
+			count += 1
+	return count
+
+def write_records(path, results):
+	return write_csv(path, results) if path.endswith('.csv') else write_jsonl(path, results)
+
+def apply_chunk(fn, chunk):
+	return [fn(record) for record in chunk]
+
+def stream_map(pool, fn, records, window=None, chunksize=64, ordered=True):
+	'Yield fn(record) for every record, with at most window chunks of chunksize records in flight'
+	window = window or 2 * os.cpu_count()
+	records = iter(records)
+	chunks = iter(lambda: list(itertools.islice(records, chunksize)), [])
+	if ordered:
+		pending = collections.deque()	# AsyncResults in submission order
+		for chunk in itertools.islice(chunks, window):
+			pending.append(pool.apply_async(apply_chunk, (fn, chunk)))
+		while pending:
+			yield from pending.popleft().get()	# Waits for the oldest; later chunks keep running
+			for chunk in itertools.islice(chunks, 1):
+				pending.append(pool.apply_async(apply_chunk, (fn, chunk)))
+	else:
+		done = queue.SimpleQueue()	# Filled by the pool's result thread
+		in_flight = 0
+		def submit(chunk):
+			pool.apply_async(apply_chunk, (fn, chunk), callback=done.put, error_callback=done.put)
+		for chunk in itertools.islice(chunks, window):
+			submit(chunk)
+			in_flight += 1
+		while in_flight:
+			results = done.get()
+			in_flight -= 1
+			if isinstance(results, BaseException):
+				raise results
+			for chunk in itertools.islice(chunks, 1):
+				submit(chunk)
+				in_flight += 1
+			yield from results
+
+def run(source, fn, sink, workers=None, window=None, chunksize=64, ordered=True):
+	'Map fn over the records in source into sink. Returns the number of results written'
+	with Pool(workers) as pool:
+		return write_records(sink, stream_map(pool, fn, read_records(source), window, chunksize, ordered))
+
+### Benchmark ###
+
+def transform(record):
+	'The Scientist transform, for records read from text files'
+	return {'name': record['name'], 'age': 2017 - int(record['born'])}
+
+def write_scientists(path, rows):
+	fields = [('Ada Lovelace', 'math', 1815, False), ('Marie Curie', 'physics', 1867, True),
+		('Tu Youyou', 'chemistry', 1930, True), ('Vera Rubin', 'astronomy', 1928, False)]
+	with open(path, 'w') as f:
+		for i, (name, field, born, nobel) in zip(range(rows), itertools.cycle(fields)):
+			f.write(json.dumps({'name': '%s %d' % (name, i), 'field': field, 'born': born, 'nobel': nobel}) + '\n')
+
+def measured(report, target, *args):
+	'Run target in a fresh process so its peak RSS is its own'
+	start = time.perf_counter()
+	target(*args)
+	report.put((time.perf_counter() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024))
+
+def pool_map_all(source, sink, workers):
+	with Pool(workers) as pool:
+		write_jsonl(sink, pool.map(transform, list(read_jsonl(source))))
+
+def benchmark(rows, workers):
+	report = {'rows': rows, 'workers': workers}
+	with tempfile.TemporaryDirectory() as tmp:
+		source, sink = os.path.join(tmp, 'scientists.jsonl'), os.path.join(tmp, 'ages.jsonl')
+		write_scientists(source, rows)
+		report['input_mb'] = round(os.path.getsize(source) / 1e6, 1)
+		for name, target, args in (('pool_map', pool_map_all, (source, sink, workers)),
+				('stream_ordered', run, (source, transform, sink, workers)),
+				('stream_unordered', run, (source, transform, sink, workers, None, 64, False))):
+			results = Queue()
+			p = Process(target=measured, args=(results, target) + args)
+			p.start()
+			seconds, peak = results.get()
+			p.join()
+			report[name] = {'seconds': round(seconds, 3), 'peak_rss_mb': round(peak / 1e6, 1)}
+	return report
+
+if __name__ == '__main__':
+	rows = int(float(sys.argv[1])) if len(sys.argv) > 1 else 10**6
+	workers = int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count()
+	print(json.dumps(benchmark(rows, workers), indent=2))
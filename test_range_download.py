@@ -0,0 +1,94 @@
+#!/usr/bin/python3
+
+"""
+Tests for range_download.py against local StandInServers.
+
+Usage: python3 -m unittest test_range_download
+"""
+import asyncio, unittest
+
+from async_fetch import Fetcher, Response, StandInServer, stand_in_body
+from range_download import bonded, content_range, download, min_segment
+
+size = 5 * min_segment + 123	# Several segments, the last one short
+
+class ShiftedFetcher(Fetcher):
+	'Asks for a different range than bonded() meant to, as a confused proxy might'
+
+	def __init__(self, shift, **options):
+		super().__init__(**options)
+		self.shift = shift
+
+	async def fetch(self, url, method='GET', headers=None):
+		if headers and 'Range' in headers:
+			start, stop = map(int, headers['Range'][len('bytes='):].split('-'))
+			headers = {'Range': 'bytes=%d-%d' % (start + self.shift, stop + self.shift)}
+		return await super().fetch(url, method, headers)
+
+def collect(url, connections=4, fetcher=None):
+	'(report, received bytes) of one download'
+	received = bytearray()
+	def process(offset, data):
+		received[len(received):] = bytes(max(offset + len(data) - len(received), 0))
+		received[offset:offset + len(data)] = data
+	if fetcher is None:
+		return download(url, process, connections), bytes(received)
+	async def main():
+		try:
+			return await bonded(fetcher, url, process, connections)
+		finally:
+			fetcher.close()
+	return asyncio.run(main()), bytes(received)
+
+class RangeDownloadTest(unittest.TestCase):
+
+	@classmethod
+	def setUpClass(cls):
+		cls.ranged = StandInServer(1, size)
+		cls.plain = StandInServer(1, size, ranges=False)
+		cls.empty = StandInServer(1, 0)
+
+	@classmethod
+	def tearDownClass(cls):
+		for server in (cls.ranged, cls.plain, cls.empty):
+			server.close()
+
+	def test_ranged_download_is_byte_for_byte(self):
+		report, received = collect(self.ranged.bases[0] + '/artifact')
+		self.assertTrue(report['ranged'])
+		self.assertGreater(report['segments'], 1)
+		self.assertEqual(report['size'], size)
+		self.assertEqual(received, stand_in_body(size))
+
+	def test_falls_back_to_one_stream_without_ranges(self):
+		report, received = collect(self.plain.bases[0] + '/artifact')
+		self.assertFalse(report['ranged'])
+		self.assertEqual(report['segments'], 1)
+		self.assertEqual(received, stand_in_body(size))
+
+	def test_empty_resource(self):
+		report, received = collect(self.empty.bases[0] + '/artifact')
+		self.assertEqual(report['size'], 0)
+		self.assertEqual(received, b'')
+
+	def test_mismatched_content_range_raises(self):
+		with self.assertRaisesRegex(ValueError, 'asked for bytes'):
+			collect(self.ranged.bases[0] + '/artifact', fetcher=ShiftedFetcher(1, limit=4, per_host=4))
+
+	def test_unsatisfiable_range_raises(self):
+		with self.assertRaisesRegex(ValueError, 'answered with 416'):
+			collect(self.ranged.bases[0] + '/artifact', fetcher=ShiftedFetcher(10 * size, limit=4, per_host=4))
+
+	def test_error_page_is_not_the_artifact(self):
+		for status in (404, 500):
+			with self.assertRaisesRegex(ValueError, 'answered with %d' % status):
+				collect(self.ranged.bases[0] + '/status/%d' % status)
+
+	def test_content_range_checks_length(self):
+		response = Response('u', 206, {'content-range': 'bytes 0-9/100'}, b'short')
+		with self.assertRaises(ValueError):
+			content_range(response, 0, 10)
+		content_range(response._replace(body=bytes(10)), 0, 10)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,161 @@
+#!/usr/bin/python3
+
+"""
+Long-lived worker pool forked from a preloaded forkserver.
+
+A Pool built for one short job pays for starting every worker and for every
+import the task needs, often more than the job itself. A WarmPool starts
+its workers from a forkserver that has already imported the preload
+modules, then keeps them for as many map() calls as you like. A worker
+retires after max_tasks items or once its resident memory passes max_rss,
+and a fresh one is forked in its place, so slow leaks in task code don't
+accumulate.
+
+Usage: ./warm_pool.py [jobs]
+"""
+import itertools, json, multiprocessing, os, queue, sys, time
+
+import primes
+
+page_size = os.sysconf('SC_PAGE_SIZE')
+poll_interval = 0.5	# Seconds between checks for workers that died without retiring
+
+def rss():
+	'Resident set size of this process in bytes'
+	with open('/proc/self/statm') as statm:
+		return int(statm.read().split()[1]) * page_size
+
+def work(tasks, results, max_tasks, max_rss):
+	'Worker loop: run chunks until told to stop or until it is time to retire'
+	done = 0
+	while True:
+		task = tasks.get()
+		if task is None:
+			return
+		job, i, fn, chunk = task
+		try:
+			results.put((job, i, True, [fn(item) for item in chunk]))
+		except Exception as e:
+			results.put((job, i, False, e))
+		done += len(chunk)
+		if max_tasks and done >= max_tasks or max_rss and rss() > max_rss:
+			results.put((None, os.getpid(), True, None))	# Retiring: the parent forks a replacement
+			return
+
+class WarmPool:
+	'Reusable pool of forkserver workers with preloaded modules. One map() at a time'
+
+	def __init__(self, processes=None, preload=(), max_tasks=None, max_rss=None):
+		self.ctx = multiprocessing.get_context('forkserver')
+		# Only honoured before the forkserver first starts; it then lives as long as this process
+		self.ctx.set_forkserver_preload(['__main__'] + list(preload))
+		self.processes = processes or os.cpu_count()
+		self.max_tasks, self.max_rss = max_tasks, max_rss
+		self.tasks, self.results = self.ctx.Queue(), self.ctx.Queue()
+		self.workers = {}	# { pid : Process }
+		self.jobs = itertools.count()
+		self.retired = 0
+		for i in range(self.processes):
+			self.spawn()
+
+	def spawn(self):
+		p = self.ctx.Process(target=work, args=(self.tasks, self.results, self.max_tasks, self.max_rss), daemon=True)
+		p.start()
+		self.workers[p.pid] = p
+
+	def replace(self, pid):
+		self.workers.pop(pid).join()
+		self.retired += 1
+		self.spawn()
+
+	def check_workers(self):
+		'A worker that died without retiring took its chunk with it: fail the map rather than hang'
+		for pid, p in list(self.workers.items()):
+			if not p.is_alive():
+				self.workers.pop(pid)
+				self.spawn()
+				raise RuntimeError('worker %d died with exit code %s' % (pid, p.exitcode))
+
+	def map(self, fn, iterable, chunksize=None):
+		'Like Pool.map(): fn over iterable in order, chunksize items per task'
+		items = list(iterable)
+		if not items:
+			return []
+		chunksize = chunksize or max(1, -(-len(items) // (4 * self.processes)))
+		chunks = [items[i:i + chunksize] for i in range(0, len(items), chunksize)]
+		job = next(self.jobs)
+		results = [None] * len(chunks)
+		submitted = received = 0
+		error = None
+		while received < submitted or submitted < len(chunks) and error is None:
+			# Two chunks per worker in flight, so the queue never holds the whole input
+			while error is None and submitted < len(chunks) and submitted - received < 2 * self.processes:
+				self.tasks.put((job, submitted, fn, chunks[submitted]))
+				submitted += 1
+			try:
+				done, i, ok, value = self.results.get(timeout=poll_interval)
+			except queue.Empty:
+				self.check_workers()
+				continue
+			if done is None:
+				self.replace(i)
+				continue
+			if done != job:
+				continue	# Left over from a map that failed
+			received += 1
+			if not ok:
+				error = error or value	# Stop submitting, collect what is in flight, then raise
+			results[i] = value
+		if error is not None:
+			raise error
+		return [result for chunk in results for result in chunk]
+
+	def close(self):
+		'Let every worker finish and exit'
+		for p in self.workers.values():
+			self.tasks.put(None)
+		for p in self.workers.values():
+			p.join(5)
+			if p.is_alive():
+				p.terminate()
+				p.join()
+		self.workers.clear()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+### Benchmark ###
+
+def first_result(make_pool, fn, items):
+	'Seconds from asking for a pool to holding the first map result'
+	start = time.perf_counter()
+	with make_pool() as pool:
+		pool.map(fn, items)
+		return time.perf_counter() - start
+
+def benchmark(jobs=5, processes=None):
+	'Time to first result for fresh fork and spawn Pools per job, against one WarmPool reused'
+	fn, items = primes.is_prime, list(range(10**9, 10**9 + 1000))
+	processes = processes or os.cpu_count()
+	report = {}
+	for name, context in (('cold_fork', 'fork'), ('cold_spawn', 'spawn')):
+		ctx = multiprocessing.get_context(context)
+		runs = [first_result(lambda: ctx.Pool(processes), fn, items) for i in range(jobs)]
+		report[name] = round(sum(runs) / jobs, 4)
+	start = time.perf_counter()
+	with WarmPool(processes, preload=['primes']) as pool:
+		report['warm_startup'] = round(time.perf_counter() - start, 4)
+		runs = []
+		for i in range(jobs):
+			start = time.perf_counter()
+			pool.map(fn, items)
+			runs.append(time.perf_counter() - start)
+	report['warm'] = round(sum(runs) / jobs, 4)
+	return report
+
+if __name__ == '__main__':
+	jobs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+	print(json.dumps({'jobs': jobs, 'seconds_to_first_result': benchmark(jobs)}, indent=2))